@@ -0,0 +1,114 @@
+# Reprocesado offline del histórico: recalcula los agregados mensuales a partir
+# de un directorio de CSV de temperatura sin pasar por la Lambda (y su límite
+# de 60 s). Usa el mismo parseo (process_csv_file) y la misma agregación que
+# funcion_lambda.py, pero reparte el parseo entre varios procesos. La fusión se
+# hace en el proceso principal en el orden de las claves ordenadas, así que la
+# regla "última gana" es la misma que en la Lambda.
+#
+# Uso:
+#   python backfill_historico.py [--datos ../Data] [--procesos 4]
+#                                [--destino sqlite|dynamodb|memoria] [--sqlite aquasense.db]
+#
+# Con --destino dynamodb se escribe en la tabla DYNAMODB_TABLE por lotes de
+# BatchWriteItem (WRITE_CONCURRENCY lotes en paralelo). No se envían alarmas:
+# solo se informa de cuántas fechas superan el umbral.
+
+###################
+#   LIBRERÍAS
+###################
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import funcion_lambda  # noqa: E402
+
+#################
+# CODE
+###############
+
+BUCKET = 'local'
+
+def init_worker(data_dir):
+    '''Cada proceso lee los CSV del directorio local'''
+    funcion_lambda.configure_backends(source=funcion_lambda.LocalObjectSource(data_dir))
+
+def parse_file(key):
+    '''Parsea un CSV en un proceso del pool (devuelve la DailySeries)'''
+    return key, funcion_lambda.process_csv_file(BUCKET, key)
+
+def build_sink(args):
+    if args.destino == 'dynamodb':
+        return funcion_lambda.DynamoDBSink()
+    if args.destino == 'sqlite':
+        return funcion_lambda.SQLiteSink(args.sqlite)
+    return funcion_lambda.MemorySink()
+
+def main():
+    parser = argparse.ArgumentParser(description='Backfill offline de los agregados mensuales')
+    parser.add_argument('--datos', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Data'))
+    parser.add_argument('--prefijo', default='', help='Prefijo de las claves a procesar')
+    parser.add_argument('--procesos', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--destino', choices=['sqlite', 'dynamodb', 'memoria'], default='sqlite')
+    parser.add_argument('--sqlite', default='aquasense.db', help='Base de datos con --destino sqlite')
+    args = parser.parse_args()
+
+    source = funcion_lambda.LocalObjectSource(args.datos)
+    sink = build_sink(args)
+    funcion_lambda.configure_backends(source=source, sink=sink)
+    timings = {}
+
+    # Listado (claves ordenadas, igual que S3)
+    start = time.perf_counter()
+    keys = list(funcion_lambda.iter_csv_keys(BUCKET, args.prefijo))
+    timings['list'] = time.perf_counter() - start
+
+    if not keys:
+        sys.exit(f"No hay CSV en {args.datos}")
+
+    # Parseo en paralelo y fusión en orden ("última gana" sobre claves ordenadas)
+    merged = funcion_lambda.DailySeries()
+    pending_alerts = {}
+    total_rows = 0
+    files_processed = 0
+    merge_time = 0.0
+
+    start = time.perf_counter()
+    chunksize = max(1, len(keys) // (args.procesos * 8))
+    with ProcessPoolExecutor(max_workers=args.procesos, initializer=init_worker, initargs=(args.datos,)) as executor:
+        for key, file_data in executor.map(parse_file, keys, chunksize=chunksize):
+            if not file_data:
+                continue
+
+            merge_start = time.perf_counter()
+            files_processed += 1
+            total_rows += len(file_data)
+            funcion_lambda.collect_alerts(pending_alerts, file_data)
+            funcion_lambda.merge_file_data(merged, file_data)
+            merge_time += time.perf_counter() - merge_start
+    timings['parse'] = time.perf_counter() - start - merge_time
+    timings['merge'] = merge_time
+
+    start = time.perf_counter()
+    monthly_metrics = funcion_lambda.aggregate_monthly_metrics(merged)
+    timings['aggregate'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    write_summary = funcion_lambda.update_monthly_aggregates(monthly_metrics)
+    timings['write'] = time.perf_counter() - start
+
+    total_time = sum(timings.values())
+    print(f"Archivos: {files_processed}/{len(keys)}   filas: {total_rows}   fechas únicas: {len(merged)}   "
+          f"duplicados: {total_rows - len(merged)}")
+    print(f"Meses: {len(monthly_metrics)}   escritos: {write_summary['items_written']}   "
+          f"sin cambios: {write_summary['months_skipped']}   fechas sobre el umbral: {len(pending_alerts)}")
+    print(f"Rendimiento: {len(keys) / total_time:,.1f} archivos/s   {total_rows / total_time:,.0f} filas/s   "
+          f"({args.procesos} procesos, {total_time:.2f} s)")
+    print("Etapas:")
+    for stage, seconds in timings.items():
+        print(f"  {stage:<10} {seconds * 1000:10.1f} ms")
+
+if __name__ == "__main__":
+    main()
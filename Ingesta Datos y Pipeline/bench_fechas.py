@@ -0,0 +1,96 @@
+# Microbenchmark del parseo de fechas del bucle de ingesta de funcion_lambda.py.
+# Compara filas/segundo entre el camino anterior (dos strptime + strftime en
+# process_csv_file y otro strptime/strftime en la fusión para detectar el
+# ajuste de mes) y el parser rápido parse_fecha (memoizado).
+#
+# Uso:
+#   python bench_fechas.py [--repeticiones 200] [--datos ../Data]
+
+###################
+#   LIBRERÍAS
+###################
+import argparse
+import csv
+import glob
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import funcion_lambda  # noqa: E402
+
+#################
+# CODE
+###############
+
+def legacy_parse(fecha_raw):
+    '''Camino anterior: parseo en process_csv_file + re-parseo en la fusión'''
+    try:
+        fecha = datetime.strptime(fecha_raw, '%Y/%m/%d')
+    except ValueError:
+        try:
+            fecha = datetime.strptime(fecha_raw, '%Y-%m-%d')
+        except ValueError:
+            return None
+
+    fecha_str = fecha.strftime('%Y-%m-%d')
+    if fecha.day <= 3:
+        adjusted_month = (fecha.replace(day=1) - timedelta(days=1)).strftime('%Y-%m')
+    else:
+        adjusted_month = fecha.strftime('%Y-%m')
+
+    # Fusión: se volvía a parsear la fecha para detectar el ajuste de mes
+    fecha_dt = datetime.strptime(fecha_str, '%Y-%m-%d')
+    month_adjusted = adjusted_month != fecha_dt.strftime('%Y-%m')
+
+    return fecha_str, adjusted_month, month_adjusted
+
+def load_fechas(data_dir):
+    '''Lee la columna Fecha de todos los CSV del directorio'''
+    fechas = []
+    for path in sorted(glob.glob(os.path.join(data_dir, '*.csv'))):
+        with open(path, encoding='utf-8') as csvfile:
+            fechas.extend(row['Fecha'] for row in csv.DictReader(csvfile))
+    return fechas
+
+def measure(parse, rows):
+    '''Devuelve filas/segundo de aplicar parse a todas las filas'''
+    start = time.perf_counter()
+    for fecha_raw in rows:
+        parse(fecha_raw)
+    return len(rows) / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmark del parseo de fechas de la ingesta')
+    parser.add_argument('--datos', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Data'))
+    parser.add_argument('--repeticiones', type=int, default=200)
+    args = parser.parse_args()
+
+    fechas = load_fechas(args.datos)
+    rows = fechas * args.repeticiones
+
+    # Comprobar que ambos caminos dan el mismo resultado
+    for fecha_raw in fechas:
+        assert legacy_parse(fecha_raw) == funcion_lambda.parse_fecha(fecha_raw), fecha_raw
+
+    def cold_parse(fecha_raw):
+        # Sin memoización: cada fila se parsea de verdad
+        funcion_lambda.parse_fecha.cache_clear()
+        funcion_lambda.adjust_month_for_date.cache_clear()
+        return funcion_lambda.parse_fecha(fecha_raw)
+
+    funcion_lambda.parse_fecha.cache_clear()
+    results = {
+        'strptime (antes)': measure(legacy_parse, rows),
+        'parse_fecha sin caché': measure(cold_parse, rows),
+        'parse_fecha (memoizado)': measure(funcion_lambda.parse_fecha, rows),
+    }
+
+    baseline = results['strptime (antes)']
+    print(f"Filas: {len(rows)} ({len(fechas)} fechas x {args.repeticiones})")
+    for name, rows_per_sec in results.items():
+        print(f"  {name:<26} {rows_per_sec:>14,.0f} filas/s  x{rows_per_sec / baseline:.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# Comparación de memoria entre la representación anterior de los datos diarios
+# (dict de dicts con Decimal + copia agrupada por mes) y la DailySeries compacta
+# de funcion_lambda.py, sobre un histórico sintético de varias décadas.
+#
+# Uso:
+#   python bench_memoria.py [--anios 50] [--filas-por-archivo 20] [--duplicados 0.4]
+
+###################
+#   LIBRERÍAS
+###################
+import argparse
+import os
+import random
+import sys
+import tracemalloc
+from collections import defaultdict
+from datetime import date, timedelta
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import funcion_lambda  # noqa: E402
+
+#################
+# CODE
+###############
+
+def synthetic_files(years, rows_per_file, duplicate_rate, seed=0):
+    '''Genera archivos sintéticos [(clave, [(fecha_raw, media, desviacion), ...])]'''
+    rng = random.Random(seed)
+    start = date(2025 - years, 1, 1)
+    days = [start + timedelta(days=i) for i in range(years * 365)]
+
+    files = []
+    cursor = 0
+    while cursor < len(days):
+        rows = []
+        for _ in range(rows_per_file):
+            if cursor and rng.random() < duplicate_rate:
+                day = days[rng.randrange(cursor)]  # fecha ya vista: duplicado
+            elif cursor < len(days):
+                day = days[cursor]
+                cursor += 1
+            else:
+                break
+            rows.append((day.strftime('%Y/%m/%d'), repr(rng.uniform(10, 30)), repr(rng.uniform(0, 1))))
+        files.append((f"temperatura_{len(files) + 1:06d}.csv", rows))
+    return files
+
+def build_legacy(files):
+    '''Estructuras anteriores: dict de dicts por archivo, fusión y agrupado mensual'''
+    merged_daily_data = {}
+    for key, rows in files:
+        file_data = {}
+        for (fecha_str, adjusted_month, _), _, media, desviacion in rows:
+            file_data[fecha_str] = {
+                'temp': funcion_lambda.round_decimal(Decimal(media)),
+                'sd': funcion_lambda.round_decimal(Decimal(desviacion)),
+                'source': key,
+                'adjusted_month': adjusted_month
+            }
+        merged_daily_data.update(file_data)
+
+    monthly_data = defaultdict(dict)
+    for fecha_str, data in merged_daily_data.items():
+        monthly_data[data['adjusted_month']][fecha_str] = data
+
+    return merged_daily_data, monthly_data
+
+def build_compact(files):
+    '''Estructura actual: DailySeries por archivo fusionada en una DailySeries'''
+    merged = funcion_lambda.DailySeries()
+    for key, rows in files:
+        file_data = funcion_lambda.DailySeries()
+        for _, (ordinal, month_id, adjusted), media, desviacion in rows:
+            file_data.upsert(
+                ordinal,
+                funcion_lambda.to_scaled(funcion_lambda.round_decimal(Decimal(media))),
+                funcion_lambda.to_scaled(funcion_lambda.round_decimal(Decimal(desviacion))),
+                month_id, key, adjusted
+            )
+        merged.merge(file_data)
+    return merged
+
+def measure(build, files):
+    '''Devuelve (pico, memoria retenida) en MiB de construir la estructura'''
+    tracemalloc.start()
+    result = build(files)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return peak / 2**20, retained / 2**20
+
+def main():
+    parser = argparse.ArgumentParser(description='Memoria de la serie diaria: dict de dicts vs DailySeries')
+    parser.add_argument('--anios', type=int, default=50)
+    parser.add_argument('--filas-por-archivo', type=int, default=20)
+    parser.add_argument('--duplicados', type=float, default=0.4)
+    args = parser.parse_args()
+
+    files = synthetic_files(args.anios, args.filas_por_archivo, args.duplicados)
+    total_rows = sum(len(rows) for _, rows in files)
+
+    # Las fechas se parsean antes de medir: solo cuenta la estructura de datos
+    files = [
+        (key, [
+            (funcion_lambda.parse_fecha(fecha_raw), funcion_lambda.parse_fecha_ordinal(fecha_raw), media, desviacion)
+            for fecha_raw, media, desviacion in rows
+        ])
+        for key, rows in files
+    ]
+
+    print(f"Histórico: {args.anios} años, {len(files)} archivos, {total_rows} filas")
+    legacy_peak, legacy_retained = measure(build_legacy, files)
+    compact_peak, compact_retained = measure(build_compact, files)
+    print(f"  dict de dicts  pico {legacy_peak:8.2f} MiB   retenida {legacy_retained:8.2f} MiB")
+    print(f"  DailySeries    pico {compact_peak:8.2f} MiB   retenida {compact_retained:8.2f} MiB")
+    print(f"  reducción      pico x{legacy_peak / compact_peak:.1f}   retenida x{legacy_retained / compact_retained:.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,468 @@
+# Benchmark por etapas de lambda_handler (funcion_lambda.py) sobre buckets
+# sintéticos. S3, DynamoDB y SNS se sustituyen por clientes falsos en memoria
+# con latencia configurable por llamada, de modo que se ejecuta el mismo
+# camino de código que en producción (S3ObjectSource, DynamoDBSink con
+# BatchWriteItem/BatchGetItem, SNSNotifier).
+#
+# Por cada tamaño de bucket se lanzan tres invocaciones: 'cold' (sin
+# estado ni agregados previos), 'warm' (mismo bucket, segundo evento) y
+# 'append' (el CSV del evento se sobrescribe con filas añadidas al final,
+# que se leen por el camino de lecturas por el final).
+# Etapas medidas: list, fetch, parse, merge, aggregate, write, alert y state
+# (manifiesto e instantánea). fetch y parse suman el tiempo de todos los hilos de descarga,
+# por eso pueden superar al total de la invocación.
+#
+# Uso:
+#   python bench_pipeline.py [--archivos 10 100 1000 10000] [--duplicados 0.4] [--filas-por-archivo 20]
+#                            [--latencia-s3 0] [--latencia-dynamodb 0] [--latencia-sns 0]
+#                            [--json resultados.json] [--comparar referencia.json --tolerancia 0.25]
+
+###################
+#   LIBRERÍAS
+###################
+import argparse
+import contextlib
+import functools
+import hashlib
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+from datetime import date, timedelta
+
+os.environ.setdefault("DYNAMODB_TABLE", "bench")
+os.environ.setdefault("CONTROL_TABLE", "bench-control")
+os.environ.setdefault("SNS_TOPIC_ARN", "arn:aws:sns:us-east-1:000000000000:bench")
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import funcion_lambda  # noqa: E402
+
+#################
+# CODE
+###############
+
+BUCKET = 'bench-bucket'
+STAGES = ('list', 'fetch', 'parse', 'merge', 'aggregate', 'write', 'alert', 'state')
+
+class StageTimer:
+    '''Tiempo acumulado y número de llamadas por etapa (seguro entre hilos)'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.seconds = {stage: 0.0 for stage in STAGES}
+        self.calls = {}
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def count(self, call):
+        with self.lock:
+            self.calls[call] = self.calls.get(call, 0) + 1
+
+class FakeS3Client:
+    '''list_objects_v2 / get_object (con Range) / put_object / copy / delete sobre un dict, con latencia por llamada'''
+
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self, timer, latency):
+        self.timer = timer
+        self.latency = latency
+        self.objects = {}
+        self._sorted_keys = None
+
+    def add(self, key, body):
+        self.objects[key] = (body, f'"{hashlib.md5(body).hexdigest()}"')
+        self._sorted_keys = None
+
+    def list_objects_v2(self, Bucket, Prefix='', ContinuationToken=None, MaxKeys=1000):
+        start = time.perf_counter()
+        self.timer.count('s3.list_objects_v2')
+        time.sleep(self.latency)
+
+        if self._sorted_keys is None:
+            self._sorted_keys = sorted(self.objects)
+        keys = [
+            key for key in self._sorted_keys
+            if key.startswith(Prefix) and (ContinuationToken is None or key > ContinuationToken)
+        ]
+        page = keys[:MaxKeys]
+        response = {
+            'Contents': [
+                {'Key': key, 'ETag': self.objects[key][1], 'Size': len(self.objects[key][0])}
+                for key in page
+            ],
+            'IsTruncated': len(keys) > len(page)
+        }
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = page[-1]
+
+        self.timer.add('list', time.perf_counter() - start)
+        return response
+
+    def get_object(self, Bucket, Key, Range=None):
+        start = time.perf_counter()
+        self.timer.count('s3.get_object')
+        time.sleep(self.latency)
+
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        data, etag = self.objects[Key]
+
+        # 'bytes=inicio-' o 'bytes=inicio-fin' (fin incluido), como S3
+        if Range is not None:
+            first, last = Range[len('bytes='):].split('-')
+            data = data[int(first):int(last) + 1 if last else None]
+
+        # Los objetos de estado se cronometran con las funciones que los leen
+        if funcion_lambda.is_csv_key(Key):
+            self.timer.add('fetch', time.perf_counter() - start)
+        return {'Body': io.BytesIO(data), 'ETag': etag}
+
+    def put_object(self, Bucket, Key, Body, ContentType=None):
+        self.timer.count('s3.put_object')
+        time.sleep(self.latency)
+        self.add(Key, Body)
+
+    def copy_object(self, Bucket, Key, CopySource):
+        self.timer.count('s3.copy_object')
+        time.sleep(self.latency)
+        self.add(Key, self.objects[CopySource['Key']][0])
+
+    def delete_object(self, Bucket, Key):
+        self.timer.count('s3.delete_object')
+        time.sleep(self.latency)
+        self.objects.pop(Key, None)
+        self._sorted_keys = None
+
+class FakeDynamoDBClient:
+    '''
+    batch_write_item / batch_get_item, put_item / update_item / delete_item
+    condicionales y query sobre un índice (recorriendo la tabla) con un dict de
+    items ya serializados por tabla. Las expresiones admitidas son las que usa
+    funcion_lambda (lease y registro de alarmas).
+    '''
+
+    class exceptions:
+        class ConditionalCheckFailedException(Exception):
+            pass
+
+    def __init__(self, timer, latency):
+        self.timer = timer
+        self.latency = latency
+        self.tables = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _check(item, condition, values):
+        '''Evalúa una ConditionExpression con OR / AND, attribute_not_exists, = y <'''
+        def term(text):
+            text = text.strip()
+            if text.startswith('attribute_not_exists('):
+                return item is None or text[len('attribute_not_exists('):-1] not in item
+            name, operator, placeholder = text.split()
+            if item is None or name not in item:
+                return False
+            (kind, current), = item[name].items()
+            (_, expected), = values[placeholder].items()
+            if kind == 'N':
+                current, expected = float(current), float(expected)
+            return current == expected if operator == '=' else current < expected
+
+        return any(all(term(part) for part in clause.split(' AND ')) for clause in condition.split(' OR '))
+
+    def _wait(self, call):
+        '''Latencia de la llamada, fuera del cerrojo (las llamadas en paralelo se solapan)'''
+        self.timer.count(f'dynamodb.{call}')
+        time.sleep(self.latency)
+
+    def _table(self, name):
+        return self.tables.setdefault(name, {})
+
+    def _conditional(self, table, Key, ConditionExpression, ExpressionAttributeValues):
+        item = table.get(Key['monthYear']['S'])
+        if ConditionExpression and not self._check(item, ConditionExpression, ExpressionAttributeValues or {}):
+            raise self.exceptions.ConditionalCheckFailedException(ConditionExpression)
+        return item
+
+    def put_item(self, TableName, Item, ConditionExpression=None, ExpressionAttributeValues=None):
+        self._wait('put_item')
+        with self.lock:
+            table = self._table(TableName)
+            self._conditional(table, Item, ConditionExpression, ExpressionAttributeValues)
+            table[Item['monthYear']['S']] = Item
+        return {}
+
+    def delete_item(self, TableName, Key, ConditionExpression=None, ExpressionAttributeValues=None):
+        self._wait('delete_item')
+        with self.lock:
+            table = self._table(TableName)
+            self._conditional(table, Key, ConditionExpression, ExpressionAttributeValues)
+            table.pop(Key['monthYear']['S'], None)
+        return {}
+
+    def update_item(self, TableName, Key, UpdateExpression, ConditionExpression=None,
+                    ExpressionAttributeValues=None, ReturnValues=None):
+        self._wait('update_item')
+        with self.lock:
+            table = self._table(TableName)
+            current = self._conditional(table, Key, ConditionExpression, ExpressionAttributeValues)
+            old = dict(current or {})
+            item = dict(current or Key)
+            action, arguments = UpdateExpression.split(' ', 1)
+
+            if action == 'SET':
+                for assignment in arguments.split(','):
+                    name, placeholder = (part.strip() for part in assignment.split('='))
+                    item[name] = ExpressionAttributeValues[placeholder]
+            elif action == 'REMOVE':
+                for name in arguments.split(','):
+                    item.pop(name.strip(), None)
+            else:  # ADD de un conjunto de cadenas
+                name, placeholder = arguments.split()
+                entries = set(item.get(name, {'SS': []})['SS']) | set(ExpressionAttributeValues[placeholder]['SS'])
+                item[name] = {'SS': sorted(entries)}
+
+            table[Key['monthYear']['S']] = item
+
+        changed = {name: value for name, value in old.items() if item.get(name) != value}
+        return {'Attributes': changed} if ReturnValues == 'UPDATED_OLD' else {}
+
+    def query(self, TableName, IndexName, KeyConditionExpression, ExpressionAttributeValues,
+              ReturnConsumedCapacity=None, ExclusiveStartKey=None):
+        self._wait('query')
+        name, _, placeholder = KeyConditionExpression.split()
+        with self.lock:
+            found = [item for item in self._table(TableName).values()
+                     if item.get(name) == ExpressionAttributeValues[placeholder]]
+        return {'Items': found, 'ConsumedCapacity': {'TableName': TableName, 'CapacityUnits': 0.5}}
+
+    def batch_write_item(self, RequestItems, ReturnConsumedCapacity=None):
+        self.timer.count('dynamodb.batch_write_item')
+        time.sleep(self.latency)
+        (table_name, requests), = RequestItems.items()
+        table = self._table(table_name)
+        for request in requests:
+            item = request['PutRequest']['Item']
+            table[item['monthYear']['S']] = item
+        return {'ConsumedCapacity': [{'TableName': table_name, 'CapacityUnits': float(len(requests))}]}
+
+    def batch_get_item(self, RequestItems, ReturnConsumedCapacity=None):
+        self.timer.count('dynamodb.batch_get_item')
+        time.sleep(self.latency)
+        (table_name, request), = RequestItems.items()
+        table = self._table(table_name)
+        found = [table[key['monthYear']['S']] for key in request['Keys'] if key['monthYear']['S'] in table]
+        return {
+            'Responses': {table_name: found},
+            'ConsumedCapacity': [{'TableName': table_name, 'CapacityUnits': len(request['Keys']) * 0.5}]
+        }
+
+class FakeSNSClient:
+
+    def __init__(self, timer, latency):
+        self.timer = timer
+        self.latency = latency
+        self.messages = []
+
+    def publish(self, TopicArn, Subject, Message):
+        self.timer.count('sns.publish')
+        time.sleep(self.latency)
+        self.messages.append((Subject, Message))
+        return {'MessageId': str(len(self.messages))}
+
+def synthetic_bucket(n_files, rows_per_file, duplicate_rate, seed=0):
+    '''Genera {clave: CSV en bytes} con fechas consecutivas y un % de fechas repetidas'''
+    rng = random.Random(seed)
+    start = date(2000, 1, 1)
+    objects = {}
+    cursor = 0
+
+    for i in range(n_files):
+        lines = ['Fecha,Medias,Desviaciones']
+        for _ in range(rows_per_file):
+            if cursor and rng.random() < duplicate_rate:
+                day = start + timedelta(days=rng.randrange(cursor))  # fecha ya vista: duplicado
+            else:
+                day = start + timedelta(days=cursor)
+                cursor += 1
+            lines.append(f"{day.strftime('%Y/%m/%d')},{rng.uniform(10, 30)!r},{rng.uniform(0, 0.6)!r}")
+        objects[f"temperatura_{i + 1:06d}.csv"] = ('\n'.join(lines) + '\n').encode('utf-8')
+
+    return objects
+
+def appended_rows(n_rows, seed=0):
+    '''Filas nuevas (fechas posteriores a las del bucket) para el escenario append'''
+    rng = random.Random(seed)
+    start = date(2090, 1, 1)
+    lines = [
+        f"{(start + timedelta(days=i)).strftime('%Y/%m/%d')},{rng.uniform(10, 30)!r},{rng.uniform(0, 0.6)!r}"
+        for i in range(n_rows)
+    ]
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+def timed(timer, stage, function):
+    '''Envuelve una función del módulo para acumular su tiempo en una etapa'''
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            timer.add(stage, time.perf_counter() - start)
+    return wrapper
+
+def instrument(timer):
+    '''Sustituye las funciones de cada etapa por versiones cronometradas; devuelve cómo restaurarlas'''
+    wrapped = {
+        'read_csv_object': 'parse',
+        'read_csv_tail': 'parse',
+        'merge_file_data': 'merge',
+        'aggregate_monthly_metrics': 'aggregate',
+        'update_monthly_aggregates': 'write',
+        'dispatch_alerts': 'alert',
+        'load_manifest': 'state',
+        'save_manifest': 'state',
+        'load_snapshot': 'state',
+        'save_snapshot': 'state',
+    }
+    originals = {name: getattr(funcion_lambda, name) for name in wrapped}
+    for name, stage in wrapped.items():
+        setattr(funcion_lambda, name, timed(timer, stage, originals[name]))
+
+    def restore():
+        for name, function in originals.items():
+            setattr(funcion_lambda, name, function)
+    return restore
+
+def run_scenario(objects, latencies):
+    '''Ejecuta las invocaciones cold, warm y append sobre un bucket; devuelve sus resultados'''
+    timer = StageTimer()
+    s3 = FakeS3Client(timer, latencies['s3'])
+    for key, body in objects.items():
+        s3.add(key, body)
+
+    # Clientes falsos detrás de los backends de producción
+    funcion_lambda._clients.update({
+        's3': s3,
+        'dynamodb': FakeDynamoDBClient(timer, latencies['dynamodb']),
+        'sns': FakeSNSClient(timer, latencies['sns']),
+    })
+    funcion_lambda.configure_backends(
+        source=funcion_lambda.S3ObjectSource(),
+        sink=funcion_lambda.DynamoDBSink(),
+        notifier=funcion_lambda.SNSNotifier()
+    )
+
+    trigger_key = max(objects)
+    event = {'Records': [{'s3': {'bucket': {'name': BUCKET}, 'object': {'key': trigger_key}}}]}
+    results = []
+
+    for invocation in ('cold', 'warm', 'append'):
+        if invocation == 'append':
+            s3.add(trigger_key, objects[trigger_key] + appended_rows(max(1, len(objects[trigger_key]) // 400)))
+
+        timer.reset()
+        restore = instrument(timer)
+        try:
+            # La línea de métricas que imprime el handler ya va en la respuesta
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                response = funcion_lambda.lambda_handler(event, None)
+                total = time.perf_counter() - start
+        finally:
+            restore()
+
+        stages = dict(timer.seconds)
+        # read_csv_object incluye la descarga: el parseo es la diferencia
+        stages['parse'] = max(stages['parse'] - stages['fetch'], 0.0)
+
+        results.append({
+            'invocation': invocation,
+            'total_ms': round(total * 1000, 3),
+            'stages_ms': {stage: round(seconds * 1000, 3) for stage, seconds in stages.items()},
+            'calls': dict(sorted(timer.calls.items())),
+            'stats': json.loads(response['body']),
+        })
+
+    return results
+
+def compare(report, reference_path, tolerance):
+    '''Devuelve los escenarios cuyo total empeora más que la tolerancia respecto a la referencia'''
+    with open(reference_path, encoding='utf-8') as f:
+        reference = json.load(f)
+
+    previous = {(r['files'], r['duplicate_rate'], r['invocation']): r['total_ms'] for r in reference['results']}
+    regressions = []
+    for result in report['results']:
+        key = (result['files'], result['duplicate_rate'], result['invocation'])
+        if key in previous and result['total_ms'] > previous[key] * (1 + tolerance):
+            regressions.append((key, previous[key], result['total_ms']))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark por etapas de la Lambda de ingesta')
+    parser.add_argument('--archivos', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('--duplicados', type=float, nargs='+', default=[0.4], help='Fracción de filas con fecha repetida')
+    parser.add_argument('--filas-por-archivo', type=int, default=20)
+    parser.add_argument('--latencia-s3', type=float, default=0.0, help='ms por llamada a S3')
+    parser.add_argument('--latencia-dynamodb', type=float, default=0.0, help='ms por llamada a DynamoDB')
+    parser.add_argument('--latencia-sns', type=float, default=0.0, help='ms por llamada a SNS')
+    parser.add_argument('--json', help='Guardar los resultados en este fichero JSON')
+    parser.add_argument('--comparar', help='JSON de una ejecución anterior con el que comparar')
+    parser.add_argument('--tolerancia', type=float, default=0.25, help='Empeoramiento admitido al comparar (0.25 = 25%%)')
+    args = parser.parse_args()
+
+    latencies = {
+        's3': args.latencia_s3 / 1000,
+        'dynamodb': args.latencia_dynamodb / 1000,
+        'sns': args.latencia_sns / 1000,
+    }
+    report = {
+        'config': {
+            'ingestion_mode': funcion_lambda.INGESTION_MODE,
+            'rows_per_file': args.filas_por_archivo,
+            'latency_ms': {service: seconds * 1000 for service, seconds in latencies.items()},
+            'fetch_workers': funcion_lambda.FETCH_WORKERS,
+            'write_concurrency': funcion_lambda.WRITE_CONCURRENCY,
+            'numpy': funcion_lambda.get_numpy() is not None,
+            'python': sys.version.split()[0],
+        },
+        'results': [],
+    }
+
+    # Imports diferidos de la Lambda (boto3.dynamodb, numpy) fuera de la medida
+    funcion_lambda.get_dynamodb_types()
+
+    for duplicate_rate in args.duplicados:
+        for n_files in args.archivos:
+            objects = synthetic_bucket(n_files, args.filas_por_archivo, duplicate_rate)
+            for result in run_scenario(objects, latencies):
+                result = {'files': n_files, 'duplicate_rate': duplicate_rate, **result}
+                report['results'].append(result)
+
+                stages = '  '.join(f"{stage} {result['stages_ms'][stage]:.1f}" for stage in STAGES)
+                print(f"{n_files:>6} archivos  dup {duplicate_rate:.2f}  {result['invocation']:<4}  "
+                      f"total {result['total_ms']:10.1f} ms  |  {stages}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+    if args.comparar:
+        regressions = compare(report, args.comparar, args.tolerancia)
+        for (n_files, duplicate_rate, invocation), before, after in regressions:
+            print(f"REGRESIÓN {n_files} archivos dup {duplicate_rate} {invocation}: {before:.1f} -> {after:.1f} ms")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
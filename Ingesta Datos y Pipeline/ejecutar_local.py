@@ -0,0 +1,101 @@
+# Ejecuta lambda_handler de funcion_lambda.py sin AWS: los CSV se leen de un
+# directorio local (que hace de bucket), los agregados van a SQLite o a memoria
+# y las alarmas se guardan en memoria. Sirve para perfilar y medir el mismo
+# camino de código que corre en producción con volúmenes de datos reales.
+# Los objetos de estado (instantánea, manifiesto...) se escriben fuera del
+# directorio de datos y solo valen junto a los agregados que describen: con
+# --sqlite se guardan en '<base>-estado/' al lado de la base y se conservan
+# entre ejecuciones; sin --sqlite (agregados en memoria) en un directorio
+# temporal que se borra al terminar. --estado fija otro directorio.
+#
+# Uso:
+#   python ejecutar_local.py [--datos ../Data] [--estado DIR] [--sqlite aquasense.db] [--modo full|incremental]
+#                            [--disparador temperatura_1.csv [temperatura_2.csv ...]] [--perfil 25]
+#
+# Con varios disparadores se envía un único evento con un registro por clave
+# (como los lotes que llegan desde una cola).
+
+###################
+#   LIBRERÍAS
+###################
+import argparse
+import cProfile
+import json
+import os
+import pstats
+import sys
+import tempfile
+import time
+
+#################
+# CODE
+###############
+
+def main():
+    parser = argparse.ArgumentParser(description='Ejecución local de la Lambda de ingesta')
+    parser.add_argument('--datos', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Data'))
+    parser.add_argument('--estado',
+                        help="Directorio de los objetos de estado (default: '<base>-estado' con --sqlite, "
+                             "si no uno temporal para esta ejecución)")
+    parser.add_argument('--sqlite', help='Guardar los agregados en esta base SQLite (por defecto en memoria)')
+    parser.add_argument('--modo', choices=['full', 'incremental'], default='full')
+    parser.add_argument('--disparador', nargs='+', help='Claves de los CSV que disparan el evento (default: la última)')
+    parser.add_argument('--perfil', type=int, metavar='N', help='Perfilar con cProfile y mostrar las N funciones más costosas')
+    args = parser.parse_args()
+
+    # La configuración de funcion_lambda se lee al importarla
+    os.environ['INGESTION_MODE'] = args.modo
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import funcion_lambda
+
+    state_dir = args.estado
+    temporary_state = None
+    if state_dir is None:
+        if args.sqlite:
+            state_dir = os.path.splitext(os.path.abspath(args.sqlite))[0] + '-estado'
+        else:
+            # Los agregados en memoria empiezan vacíos: el estado también
+            temporary_state = tempfile.TemporaryDirectory(prefix='aquasense-estado-')
+            state_dir = temporary_state.name
+
+    try:
+        run(funcion_lambda, args, state_dir)
+    finally:
+        if temporary_state is not None:
+            temporary_state.cleanup()
+
+def run(funcion_lambda, args, state_dir):
+    source = funcion_lambda.LocalObjectSource(args.datos, state_root=state_dir)
+    sink = funcion_lambda.SQLiteSink(args.sqlite) if args.sqlite else funcion_lambda.MemorySink()
+    notifier = funcion_lambda.MemoryNotifier()
+    funcion_lambda.configure_backends(source=source, sink=sink, notifier=notifier)
+
+    trigger_keys = args.disparador
+    if trigger_keys is None:
+        keys = list(funcion_lambda.iter_csv_keys('local', funcion_lambda.INPUT_PREFIX))
+        if not keys:
+            sys.exit(f"No hay CSV en {args.datos}")
+        trigger_keys = [keys[-1]]
+
+    event = {'Records': [
+        {'s3': {'bucket': {'name': 'local'}, 'object': {'key': key}}}
+        for key in trigger_keys
+    ]}
+
+    profiler = cProfile.Profile() if args.perfil else None
+    start = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    response = funcion_lambda.lambda_handler(event, None)
+    if profiler:
+        profiler.disable()
+    elapsed = time.perf_counter() - start
+
+    print(json.dumps(json.loads(response['body']), indent=2, ensure_ascii=False))
+    print(f"Tiempo: {elapsed * 1000:.1f} ms   mensajes de alarma: {len(notifier.messages)}")
+
+    if profiler:
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(args.perfil)
+
+if __name__ == "__main__":
+    main()
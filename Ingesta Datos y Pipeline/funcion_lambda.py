@@ -9,319 +9,3734 @@ Descripción:
 
 Funcionalidades:
     - Lectura de TODOS los archivos CSV del bucket (no solo el trigger)
+    - Instantánea columnar de la serie diaria (un GET) con los objetos que ya
+      incluye: solo se leen los CSV nuevos
+    - Manifiesto por ETag: al reconstruir, los CSV sin cambios se sirven desde el estado sin GET
     - Detección y sobrescritura de fechas duplicadas (última gana)
     - Parsing flexible de múltiples formatos de fecha
     - Cálculo de métricas mensuales (temperatura media, desviación máxima, diferencias)
+      en una sola pasada agrupada sobre columnas (NumPy si está instalado; la
+      función desplegada con la plantilla usa el motor en Python puro)
     - Detección de alarmas (desviación > 0.5ºC)
-    - Actualización de DynamoDB con datos procesados
-    - Envió de notificaciones SNS
+    - Actualización de DynamoDB con datos procesados (BatchWriteItem de 25 en 25)
+    - Envió de notificaciones SNS: cada alarma (fecha, umbral) se envía una sola
+      vez y las nuevas de una invocación se agrupan en un único resumen
     - Ajuste de mes: si el día es <= 3, se asigna al mes anterior
+    - Métricas por invocación (tiempo por etapa, llamadas S3/DynamoDB/SNS,
+      bytes leídos, CPU) en la respuesta y en una línea de log JSON
+    - Modo incremental: solo se procesan los archivos que disparan el evento y se
+      recalculan los meses afectados
+    - Eventos con varios registros (p. ej. por lotes desde una cola SQS): se
+      deduplican por (bucket, clave) y se procesan en una sola pasada, con
+      el resultado de cada registro en 'records'
+    - Coalescencia de ráfagas (COALESCE_ENABLED): un lease en la tabla de
+      control hace que una sola invocación recalcule mientras las demás solo
+      dejan su clave como pendiente
+    - Idempotencia: cada registro (bucket, clave, sequencer/ETag) procesado se
+      marca en la tabla de control con TTL; los reintentos y notificaciones repetidas
+      responden "duplicate" sin listar el bucket
+    - Lecturas por el final: si un CSV ya incluido se sobrescribe con una versión
+      que solo añade filas, se parsean únicamente las nuevas (sin reconstruir
+      la serie); con TAIL_VERIFY=window además solo se descargan esas filas
+    - CSV comprimidos (*.csv.gz y, si está instalado zstandard, *.csv.zst): se
+      descomprimen en streaming hacia el parser, con los bytes comprimidos y
+      descomprimidos en las métricas
+
+Modos de ingesta (INGESTION_MODE):
+    - full:        lista todo el bucket en cada evento (por defecto). Parte de
+                   la instantánea '<STATE_PREFIX>daily_snapshot.bin' y fusiona
+                   los CSV que no incluye; si alguno de los incluidos ha
+                   cambiado o se ha borrado, relee todos los CSV. Solo se
+                   recalculan los meses que cambian respecto a la
+                   instantánea y su mes siguiente (todos si no existe).
+    - incremental: carga la instantánea, fusiona solo los archivos del evento
+                   (misma regla "última gana") y recalcula únicamente los
+                   meses ajustados que cambian y su mes siguiente (por
+                   max_diff_temp). Si no existe instantánea, se inicializa
+                   con una pasada completa. Las pasadas se serializan
+                   siempre con el lease de la coalescencia: como no se
+                   lista el bucket, dos invocaciones que guardasen la
+                   instantánea a la vez perderían para siempre los
+                   archivos de una de ellas.
+
+Compactación (evento {"action": "compact", "bucket": "<bucket>"}):
+    Reescribe los CSV sueltos en un archivo por mes ajustado con la columna
+    'Origen' (archivo original de cada fila) y archiva los originales, con
+    el lease de la ingesta tomado. El resultado de la ingesta no cambia.
 
 Triggers:
     - S3 ObjectCreated:* en bucket proy-marmenor-data-raw-*
-    - Filtro: archivos *.csv
+      (directamente o a través de una cola SQS)
+    - Filtro: archivos *.csv, *.csv.gz y *.csv.zst (la extensión en minúsculas o
+      en mayúsculas)
 
-Variables de Entorno Requeridas:
+Variables de Entorno Requeridas (con los backends de AWS):
     - DYNAMODB_TABLE: Nombre de la tabla DynamoDB
+    - CONTROL_TABLE: Tabla DynamoDB de los items de control (lease, registro de
+      alarmas y marcadores de eventos), separada de la que sirve el dashboard
     - SNS_TOPIC_ARN: ARN del topic SNS para alarmas
     - DESVIATION_THRESHOLD: Umbral de desviación (default: 0.5)
+
+Variables de Entorno Opcionales:
+    - INGESTION_MODE: 'full' o 'incremental' (default: full)
+    - STATE_PREFIX: Prefijo de los objetos de estado en el bucket (default: _estado/)
+    - INPUT_PREFIX: Prefijo de los CSV a procesar dentro del bucket (default: todo el bucket)
+    - FETCH_WORKERS: Hilos para descargar y parsear CSV en paralelo (default: 8)
+    - MANIFEST_ENABLED: Usar el manifiesto de ETags para no releer CSV sin cambios (default: true)
+    - SNAPSHOT_ENABLED: Mantener la instantánea de la serie diaria en modo full (default: true)
+    - COMPACTED_PREFIX: Prefijo de los CSV compactados por mes, dentro de INPUT_PREFIX (default: compactado/)
+    - ARCHIVE_PREFIX: Prefijo donde la compactación archiva los CSV originales, dentro de
+      INPUT_PREFIX (default: _archivo/)
+    - WRITE_CONCURRENCY: Lotes BatchWriteItem enviados en paralelo (default: 1)
+    - READ_CONCURRENCY: Peticiones BatchGetItem enviadas en paralelo (default: 4)
+    - ALERT_LEDGER_ENABLED: Enviar cada alarma una sola vez usando el registro de la tabla (default: true)
+    - ALERT_DIGEST_SIZE: Máximo de alarmas por mensaje resumen SNS (default: 200)
+    - ALERT_CLAIM_SECONDS: Tiempo que una invocación se reserva las alarmas que publica;
+      no debe ser menor que el timeout de la función (default: 60)
+    - SKIP_UNCHANGED_MONTHS: No reescribir meses cuyo content_hash no cambia (default: true)
+    - COALESCE_ENABLED: Coalescer las ráfagas de subidas con un lease en la tabla de control; en modo
+      incremental se usa siempre (default: false)
+    - COALESCE_WINDOW_SECONDS: Validez del lease en segundos; se renueva en cada pasada y no
+      debe ser menor que el timeout de la función (default: 60)
+    - IDEMPOTENCY_ENABLED: Marcar los eventos procesados y descartar los repetidos (default: true)
+    - IDEMPOTENCY_TTL_SECONDS: Tiempo que se recuerda un evento procesado (default: 86400)
+    - TAIL_READS_ENABLED: Leer solo lo añadido a los CSV que crecen por el final (default: true)
+    - TAIL_VERIFY: Cómo se comprueba que un CSV solo ha crecido: 'prefix' (hash de lo ya
+      ingerido, exacto) o 'window' (GET con rango de cabecera y ventana final) (default: prefix)
+    - TAIL_WINDOW_BYTES: Bytes finales de cada CSV que se comparan con TAIL_VERIFY=window (default: 4096)
+    - AGGREGATION_ENGINE: Motor de la agregación mensual: 'auto' (NumPy si está instalado),
+      'numpy' (la función no arranca sin NumPy) o 'python' (default: auto). NumPy no se
+      despliega con la función (ni capa ni dependencias en el zip)
+    - SOURCE_BACKEND: Origen de los objetos: 's3', 'local' o 'memory' (default: s3)
+    - SINK_BACKEND: Destino de los agregados: 'dynamodb', 'sqlite' o 'memory' (default: dynamodb)
+    - ALERT_BACKEND: Canal de las alarmas: 'sns' o 'memory' (default: sns)
+    - LOCAL_SOURCE_DIR: Directorio que hace de bucket con SOURCE_BACKEND=local (default: .)
+    - SQLITE_PATH: Base de datos con SINK_BACKEND=sqlite (default: aquasense.db)
 """
 
 import json
-import boto3
 import csv
+import gzip
+import hashlib
+import importlib.util
+import io
 import os
+import re
+import shutil
+import struct
+import sys
+import threading
+import time
 import urllib.parse
-from datetime import datetime, timedelta
+import uuid
+from array import array
+from datetime import date, datetime, timedelta
 from decimal import Decimal
-from collections import defaultdict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 
 # ============================================================================
 # CONFIGURACIÓN Y CLIENTES AWS
 # ============================================================================
 
-s3_client = boto3.client("s3")
-dynamodb = boto3.resource("dynamodb")
-sns_client = boto3.client("sns")
+# Los clientes boto3 (y el propio import de boto3) se crean la primera vez que
+# se usan y se reutilizan entre invocaciones: el arranque en frío no paga por
+# servicios que la invocación no llega a tocar. Para DynamoDB se usa el
+# cliente de bajo nivel en lugar de boto3.resource.
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(service_name):
+    """Devuelve (creándolo una sola vez, también entre hilos) el cliente boto3 del servicio."""
+    client = _clients.get(service_name)
+
+    if client is None:
+        # La sesión por defecto de boto3 no es segura para crear clientes en paralelo
+        with _clients_lock:
+            client = _clients.get(service_name)
+            if client is None:
+                import boto3
+                client = boto3.client(service_name)
+                _clients[service_name] = client
+
+    return client
+
+
+def get_s3_client():
+    return get_client("s3")
+
+
+def get_sns_client():
+    return get_client("sns")
+
+
+def get_dynamodb_client():
+    return get_client("dynamodb")
+
+
+@lru_cache(maxsize=None)
+def get_dynamodb_types():
+    """(TypeSerializer, TypeDeserializer) para traducir items del cliente de bajo nivel."""
+    from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+    return TypeSerializer(), TypeDeserializer()
+
+
+def get_numpy():
+    """
+    NumPy para la agregación mensual según AGGREGATION_ENGINE, o None para
+    usar el bucle equivalente en Python puro. NumPy es opcional (no viene
+    en el runtime de Lambda ni se despliega con la función) y se importa
+    solo al agregar.
+    """
+    if AGGREGATION_ENGINE == "python":
+        return None
+    return import_numpy()
+
+
+@lru_cache(maxsize=None)
+def import_numpy():
+    """Módulo numpy, o None si no está instalado."""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def check_aggregation_engine():
+    """
+    Valida AGGREGATION_ENGINE al cargar el módulo. Con 'numpy' la función no
+    arranca si NumPy no está instalado, en lugar de pasar sin avisar al
+    motor en Python puro (solo se busca el paquete, sin importarlo).
+    """
+    if AGGREGATION_ENGINE not in ("auto", "numpy", "python"):
+        raise ValueError(f"Unknown AGGREGATION_ENGINE: {AGGREGATION_ENGINE}")
+    if AGGREGATION_ENGINE == "numpy" and importlib.util.find_spec("numpy") is None:
+        raise RuntimeError("AGGREGATION_ENGINE=numpy but numpy is not installed")
+
+
+def get_zstandard():
+    """
+    zstandard es opcional (no viene en el runtime de Lambda) y solo hace
+    falta para los *.csv.zst. Devuelve None si no está instalado.
+    """
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
 
-# Variables de entorno
-DYNAMODB_TABLE = os.environ["DYNAMODB_TABLE"]
-SNS_TOPIC_ARN = os.environ["SNS_TOPIC_ARN"]
+def get_table_name():
+    """Nombre de la tabla DynamoDB (variable de entorno obligatoria)."""
+    return os.environ["DYNAMODB_TABLE"]
+
+
+def get_control_table_name():
+    """Nombre de la tabla DynamoDB de los items de control (variable de entorno obligatoria)."""
+    return os.environ["CONTROL_TABLE"]
+
+
+def get_sns_topic_arn():
+    """ARN del topic SNS de alarmas (variable de entorno obligatoria)."""
+    return os.environ["SNS_TOPIC_ARN"]
+
+
+# Variables de entorno (las obligatorias se leen al usarse)
 DEVIATION_THRESHOLD = Decimal(str(os.environ.get("DEVIATION_THRESHOLD", "0.5")))
+INGESTION_MODE = os.environ.get("INGESTION_MODE", "full").lower()
+STATE_PREFIX = os.environ.get("STATE_PREFIX", "_estado/")
+INPUT_PREFIX = os.environ.get("INPUT_PREFIX", "")
+FETCH_WORKERS = int(os.environ.get("FETCH_WORKERS", "8"))
+MANIFEST_ENABLED = os.environ.get("MANIFEST_ENABLED", "true").lower() == "true"
+SNAPSHOT_ENABLED = os.environ.get("SNAPSHOT_ENABLED", "true").lower() == "true"
+# Compactados y archivados van dentro de INPUT_PREFIX: la ingesta solo lista ese prefijo
+COMPACTED_PREFIX = INPUT_PREFIX + os.environ.get("COMPACTED_PREFIX", "compactado/")
+ARCHIVE_PREFIX = INPUT_PREFIX + os.environ.get("ARCHIVE_PREFIX", "_archivo/")
+WRITE_CONCURRENCY = int(os.environ.get("WRITE_CONCURRENCY", "1"))
+READ_CONCURRENCY = int(os.environ.get("READ_CONCURRENCY", "4"))
+ALERT_LEDGER_ENABLED = os.environ.get("ALERT_LEDGER_ENABLED", "true").lower() == "true"
+ALERT_DIGEST_SIZE = int(os.environ.get("ALERT_DIGEST_SIZE", "200"))
+ALERT_CLAIM_SECONDS = int(os.environ.get("ALERT_CLAIM_SECONDS", "60"))
+SKIP_UNCHANGED_MONTHS = os.environ.get("SKIP_UNCHANGED_MONTHS", "true").lower() == "true"
+COALESCE_ENABLED = os.environ.get("COALESCE_ENABLED", "false").lower() == "true"
+COALESCE_WINDOW_SECONDS = int(os.environ.get("COALESCE_WINDOW_SECONDS", "60"))
+IDEMPOTENCY_ENABLED = os.environ.get("IDEMPOTENCY_ENABLED", "true").lower() == "true"
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get("IDEMPOTENCY_TTL_SECONDS", "86400"))
+TAIL_READS_ENABLED = os.environ.get("TAIL_READS_ENABLED", "true").lower() == "true"
+TAIL_VERIFY = os.environ.get("TAIL_VERIFY", "prefix").lower()
+TAIL_WINDOW_BYTES = int(os.environ.get("TAIL_WINDOW_BYTES", "4096"))
+AGGREGATION_ENGINE = os.environ.get("AGGREGATION_ENGINE", "auto").lower()
+
+# Backends (ver BACKENDS DE ALMACENAMIENTO)
+SOURCE_BACKEND = os.environ.get("SOURCE_BACKEND", "s3").lower()
+SINK_BACKEND = os.environ.get("SINK_BACKEND", "dynamodb").lower()
+ALERT_BACKEND = os.environ.get("ALERT_BACKEND", "sns").lower()
+LOCAL_SOURCE_DIR = os.environ.get("LOCAL_SOURCE_DIR", ".")
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "aquasense.db")
+
+check_aggregation_engine()
 
-# Tabla DynamoDB
-table = dynamodb.Table(DYNAMODB_TABLE)
+# Métricas que entran en el content_hash de cada mes
+MONTH_METRIC_FIELDS = ('monthYear', 'max_temp', 'max_sd', 'mean_temp', 'max_diff_temp', 'mean_temp_count')
+
+# Límites de BatchWriteItem / BatchGetItem
+BATCH_WRITE_SIZE = 25
+BATCH_GET_SIZE = 100
+BATCH_MAX_RETRIES = 8
+BATCH_RETRY_BASE_DELAY = 0.05
+
+# Instantánea columnar de la serie diaria fusionada + objetos que ya incluye
+SNAPSHOT_KEY = f"{STATE_PREFIX}daily_snapshot.bin"
+SNAPSHOT_MAGIC = b"AQSNAP01"
+
+# Manifiesto clave -> ETag -> datos parseados (evita releer CSV sin cambios)
+MANIFEST_KEY = f"{STATE_PREFIX}manifest.json"
+
+# Item de la tabla de control con el lease de la ingesta y las claves
+# pendientes. La tabla de control tiene la misma clave (monthYear) que la de
+# agregados y sus items empiezan por '_'.
+LEASE_KEY = "_lease"
+
+# Registro de alarmas en la tabla de control: un item '_alert#<fecha>|<umbral>'
+# por alarma (se crea una sola vez). Mientras no se ha publicado lleva
+# alert_state = ALERT_PENDING, que lo pone en el índice disperso
+# ALERT_STATE_INDEX, y la invocación que lo publica lo reserva con
+# claim_owner / claim_expires. Al publicarlo se reescribe con sent_at y sin
+# alert_state.
+ALERT_ITEM_PREFIX = "_alert#"
+ALERT_PENDING = "pending"
+ALERT_STATE_INDEX = "alert_state-index"
+
+# Marcadores de eventos ya procesados: '_event#<bucket>/<clave>#<sequencer>'
+# con caducidad en 'expires_at' (atributo TTL de la tabla de control)
+EVENT_MARKER_PREFIX = "_event#"
+
+# Extensiones de los CSV que se ingieren y compresión de cada una
+CSV_COMPRESSIONS = {'.csv': None, '.csv.gz': 'gzip', '.csv.zst': 'zstd'}
 
 
 # ============================================================================
-# FUNCIONES AUXILIARES
+# BACKENDS DE ALMACENAMIENTO (ORIGEN DE OBJETOS, DESTINO DE AGREGADOS, ALERTAS)
 # ============================================================================
+#
+# El pipeline solo habla con estas tres interfaces. En Lambda se usan S3,
+# DynamoDB y SNS; fuera de AWS el mismo código se ejecuta contra un
+# directorio local (p. ej. ./Data), SQLite o estructuras en memoria.
 
-def round_decimal(value):
-    """Redondea un valor Decimal a 4 decimales."""
-    return value.quantize(Decimal("0.0001"))
+class ObjectSource:
+    """Origen de objetos: CSV de entrada y objetos de estado."""
 
-def adjust_month_for_date(fecha_dt):
+    def list_objects(self, bucket, prefix="", continuation_token=None):
+        """Una página del listado con el formato de list_objects_v2 ('Contents', 'IsTruncated', ...)."""
+        raise NotImplementedError
+
+    def open_object(self, bucket, key, start=None, end=None):
+        """
+        (flujo binario con read y close, ETag) del objeto. Con 'start' solo
+        se leen los bytes [start, end] (hasta el final si end es None).
+        """
+        raise NotImplementedError
+
+    def read_object(self, bucket, key):
+        """Contenido del objeto en bytes, o None si no existe."""
+        raise NotImplementedError
+
+    def write_object(self, bucket, key, body, content_type=None):
+        raise NotImplementedError
+
+    def copy_object(self, bucket, source_key, target_key):
+        raise NotImplementedError
+
+    def delete_object(self, bucket, key):
+        raise NotImplementedError
+
+
+class S3ObjectSource(ObjectSource):
+
+    def list_objects(self, bucket, prefix="", continuation_token=None):
+        request = {'Bucket': bucket}
+        if prefix:
+            request['Prefix'] = prefix
+        if continuation_token:
+            request['ContinuationToken'] = continuation_token
+        return get_s3_client().list_objects_v2(**request)
+
+    def open_object(self, bucket, key, start=None, end=None):
+        request = {'Bucket': bucket, 'Key': key}
+        if start is not None:
+            request['Range'] = f"bytes={start}-{'' if end is None else end}"
+        response = get_s3_client().get_object(**request)
+        return response['Body'], response.get('ETag')
+
+    def read_object(self, bucket, key):
+        try:
+            response = get_s3_client().get_object(Bucket=bucket, Key=key)
+        except get_s3_client().exceptions.NoSuchKey:
+            return None
+
+        return response['Body'].read()
+
+    def write_object(self, bucket, key, body, content_type=None):
+        request = {'Bucket': bucket, 'Key': key, 'Body': body}
+        if content_type:
+            request['ContentType'] = content_type
+        get_s3_client().put_object(**request)
+
+    def copy_object(self, bucket, source_key, target_key):
+        get_s3_client().copy_object(
+            Bucket=bucket,
+            Key=target_key,
+            CopySource={'Bucket': bucket, 'Key': source_key}
+        )
+
+    def delete_object(self, bucket, key):
+        get_s3_client().delete_object(Bucket=bucket, Key=key)
+
+
+class LocalObjectSource(ObjectSource):
     """
-    Ajusta el mes de una fecha según el día.
-    Si el día es <= 3, se asigna al mes anterior.
-    
-    Args:
-        fecha_dt: datetime object
-    
-    Returns:
-        str: Mes en formato 'YYYY-MM' ajustado
+    Directorio local como bucket: las claves son rutas relativas con '/'.
+
+    El nombre del bucket se ignora. El ETag se deriva del tamaño y la fecha
+    de modificación (no obliga a leer el archivo para listarlo). Con
+    'state_root', los objetos de estado (STATE_PREFIX) se guardan en ese
+    directorio en lugar de dentro de 'root'.
     """
-    if fecha_dt.day <= 3:
-        # Mover al mes anterior
-        adjusted_date = fecha_dt.replace(day=1) - timedelta(days=1)
-        return adjusted_date.strftime('%Y-%m')
-    else:
-        return fecha_dt.strftime('%Y-%m')
 
-def send_alert(fecha_str, desviacion, temp_media, filename):
-    """Envía una alerta por SNS."""
-    try:
-        fecha_dt = datetime.strptime(fecha_str, '%Y/%m/%d')
-        fecha_formatted = fecha_dt.strftime("%Y-%m-%d")
-        
-        subject = "⚠️ Alarma Mar Menor - Desviación Alta Detectada"
-        message = f"""
-⚠️ ALERTA DE TEMPERATURA - MAR MENOR
-=========================================
-Se ha detectado una desviación superior al umbral.
+    def __init__(self, root, page_size=1000, state_root=None):
+        self.root = os.path.abspath(root)
+        self.page_size = page_size
+        self.state_root = os.path.abspath(state_root) if state_root else None
 
-📊 DETALLES
------------------------------------------
-- Fecha:        {fecha_formatted}
-- Desviación:   {float(desviacion):.4f}°C ⚠️
-- Umbral:       {float(DEVIATION_THRESHOLD):.2f}°C
-- Temp Media:   {float(temp_media):.2f}°C
-- Archivo:      {filename}
+    def _path(self, key):
+        if self.state_root and key.startswith(STATE_PREFIX):
+            return os.path.join(self.state_root, *key[len(STATE_PREFIX):].split('/'))
+        return os.path.join(self.root, *key.split('/'))
 
---
-Sistema AquaSenseCloud
-        """.strip()
+    @staticmethod
+    def _etag(stat):
+        return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
 
-        sns_client.publish(
-            TopicArn=SNS_TOPIC_ARN, 
-            Subject=subject, 
-            Message=message
+    def list_objects(self, bucket, prefix="", continuation_token=None):
+        keys = []
+        for dirpath, _, filenames in os.walk(self.root):
+            relative = os.path.relpath(dirpath, self.root)
+            for filename in filenames:
+                key = filename if relative == '.' else f"{relative.replace(os.sep, '/')}/{filename}"
+                if key.startswith(prefix) and (continuation_token is None or key > continuation_token):
+                    keys.append(key)
+
+        keys.sort()
+        page = keys[:self.page_size]
+        contents = []
+        for key in page:
+            stat = os.stat(self._path(key))
+            contents.append({'Key': key, 'ETag': self._etag(stat), 'Size': stat.st_size})
+
+        response = {'Contents': contents, 'IsTruncated': len(keys) > len(page)}
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = page[-1]
+        return response
+
+    def open_object(self, bucket, key, start=None, end=None):
+        body = open(self._path(key), 'rb')
+        etag = self._etag(os.fstat(body.fileno()))
+        if start is None:
+            return body, etag
+
+        with body:
+            body.seek(start)
+            return io.BytesIO(body.read() if end is None else body.read(end - start + 1)), etag
+
+    def read_object(self, bucket, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write_object(self, bucket, key, body, content_type=None):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Escritura atómica: un lector nunca ve el objeto a medias
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+
+    def copy_object(self, bucket, source_key, target_key):
+        target_path = self._path(target_key)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        shutil.copyfile(self._path(source_key), target_path)
+
+    def delete_object(self, bucket, key):
+        os.remove(self._path(key))
+
+
+class MemoryObjectSource(ObjectSource):
+    """Buckets en memoria: {bucket: {clave: bytes}}. El ETag es el MD5 como en S3."""
+
+    def __init__(self, buckets=None, page_size=1000):
+        self.buckets = {}
+        self.page_size = page_size
+        for bucket, objects in (buckets or {}).items():
+            for key, body in objects.items():
+                self.write_object(bucket, key, body)
+
+    def list_objects(self, bucket, prefix="", continuation_token=None):
+        objects = self.buckets.get(bucket, {})
+        keys = sorted(
+            key for key in objects
+            if key.startswith(prefix) and (continuation_token is None or key > continuation_token)
         )
-    except Exception as e:
-        print(f"Error enviando alerta SNS: {str(e)}")
+        page = keys[:self.page_size]
 
+        response = {
+            'Contents': [
+                {'Key': key, 'ETag': objects[key][1], 'Size': len(objects[key][0])}
+                for key in page
+            ],
+            'IsTruncated': len(keys) > len(page)
+        }
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = page[-1]
+        return response
 
-def get_all_csv_files(bucket):
-    """Obtiene lista de todos los archivos CSV del bucket ordenados alfabéticamente."""
-    try:
-        response = s3_client.list_objects_v2(Bucket=bucket)
-        
-        if 'Contents' not in response:
-            return []
-        
-        # Filtrar solo CSVs y ordenar alfabéticamente
-        csv_files = sorted([
-            obj['Key'] for obj in response['Contents'] 
-            if obj['Key'].lower().endswith('.csv')
-        ])
-        
-        return csv_files
-        
-    except Exception as e:
-        print(f"Error listing bucket contents: {e}")
-        return []
+    def open_object(self, bucket, key, start=None, end=None):
+        body, etag = self.buckets[bucket][key]
+        if start is not None:
+            body = body[start:] if end is None else body[start:end + 1]
+        return io.BytesIO(body), etag
 
+    def read_object(self, bucket, key):
+        entry = self.buckets.get(bucket, {}).get(key)
+        return entry[0] if entry is not None else None
 
-def process_csv_file(bucket, key, local_dir):
+    def write_object(self, bucket, key, body, content_type=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.buckets.setdefault(bucket, {})[key] = (body, f'"{hashlib.md5(body).hexdigest()}"')
+
+    def copy_object(self, bucket, source_key, target_key):
+        objects = self.buckets[bucket]
+        objects[target_key] = objects[source_key]
+
+    def delete_object(self, bucket, key):
+        del self.buckets[bucket][key]
+
+
+class AggregateSink:
     """
-    Descarga y procesa un archivo CSV.
-    Retorna diccionario de fechas: {'2023-01-15': {'temp': 20, 'sd': 0.5, 'source': 'file.csv', 'adjusted_month': '2023-01'}}
+    Destino de los agregados mensuales (un item por monthYear).
+
+    Los items de control no se mezclan con los meses: viven en el destino
+    que devuelve control_sink(), con la misma interfaz. Allí están el lease
+    de la ingesta (ver COALESCENCIA DE RÁFAGAS): un item con su dueño, su
+    caducidad y las claves pendientes, el registro de alarmas (ver REGISTRO
+    DE ALERTAS) y los marcadores de eventos. Los destinos locales lo
+    implementan sobre _update_item, que aplica una función al item de forma
+    atómica.
     """
-    local_filename = os.path.join(local_dir, os.path.basename(key))
-    daily_data = {}
-    
-    try:
-        s3_client.download_file(bucket, key, local_filename)
-        
-        with open(local_filename, encoding='utf-8') as csvfile:
-            reader = csv.DictReader(csvfile, delimiter=',')
-            
-            for row in reader:
-                # Parseo de fecha
-                try:
-                    fecha = datetime.strptime(row['Fecha'], '%Y/%m/%d')
-                except ValueError:
-                    try:
-                        fecha = datetime.strptime(row['Fecha'], '%Y-%m-%d')
-                    except ValueError:
-                        print(f"Warning: Invalid date format in {key}: {row['Fecha']}")
-                        continue
-                
-                fecha_str = fecha.strftime('%Y-%m-%d')
-                temp_media = round_decimal(Decimal(row['Medias']))
-                desviacion = round_decimal(Decimal(row['Desviaciones']))
-                
-                # Ajustar mes según el día (si día <= 3, va al mes anterior)
-                adjusted_month = adjust_month_for_date(fecha)
-
-                # Guardar (sobrescribe si ya existe en este archivo)
-                daily_data[fecha_str] = {
-                    'temp': temp_media,
-                    'sd': desviacion,
-                    'source': key,
-                    'adjusted_month': adjusted_month  # Mes ajustado
-                }
-        
-        return daily_data
-        
-    except Exception as e:
-        print(f"Error processing file {key}: {e}")
-        return {}
-    
-    finally:
-        if os.path.exists(local_filename):
-            os.remove(local_filename)
 
+    def control_sink(self):
+        """Destino de los items de control asociado a este (se crea una sola vez)."""
+        raise NotImplementedError
 
-# ============================================================================
-# HANDLER PRINCIPAL
-# ============================================================================
+    def get_items(self, month_keys, projection=None):
+        """Devuelve ({monthYear: item}, resumen de lectura) como batch_get_items."""
+        raise NotImplementedError
 
-def lambda_handler(event, context):
+    def put_items(self, items):
+        """Escribe (reemplaza) los items y devuelve un resumen como batch_write_items."""
+        raise NotImplementedError
 
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    trigger_key = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'])
-    
-    local_dir = "/tmp"
-    
-    try:
-        # ============================================================
-        # PASO 1: Obtener TODOS los archivos CSV del bucket
-        # ============================================================
-        all_csv_files = get_all_csv_files(bucket)
-        
-        if not all_csv_files:
-            return {
-                "statusCode": 200,
-                "body": json.dumps({
-                    "message": "No CSV files found in bucket",
-                    "trigger_file": trigger_key
-                })
+    def delete_items(self, month_keys):
+        """Borra los items (los que no existen se ignoran)."""
+        for key in month_keys:
+            self._update_item(key, lambda item: (None, None))
+
+    def _update_item(self, key, update):
+        """Aplica update(item o None) -> (item nuevo o None para borrarlo, resultado) de forma atómica."""
+        raise NotImplementedError
+
+    def add_pending(self, lease_key, entries):
+        """Añade 'entries' al conjunto de claves pendientes del lease."""
+        def update(item):
+            item = item or {'monthYear': lease_key}
+            item['pending_keys'] = set(item.get('pending_keys', ())) | set(entries)
+            return item, None
+
+        self._update_item(lease_key, update)
+
+    def acquire_lease(self, lease_key, owner, now, expires):
+        """Toma (o renueva) el lease si está libre, caducado o ya es de 'owner'."""
+        def update(item):
+            item = item or {'monthYear': lease_key}
+            if item.get('lease_owner') not in (None, owner) and item['lease_expires'] >= now:
+                return item, False
+            item['lease_owner'] = owner
+            item['lease_expires'] = expires
+            return item, True
+
+        return self._update_item(lease_key, update)
+
+    def take_pending(self, lease_key, owner):
+        """Saca y devuelve las claves pendientes, o None si 'owner' ya no tiene el lease."""
+        def update(item):
+            if item is None or item.get('lease_owner') != owner:
+                return item, None
+            return item, sorted(item.pop('pending_keys', ()))
+
+        return self._update_item(lease_key, update)
+
+    def query_items(self, index, attribute, value):
+        """
+        Items cuyo atributo 'attribute' vale 'value' y resumen de lectura. En
+        DynamoDB es un Query (paginado) sobre el índice disperso 'index'.
+        """
+        raise NotImplementedError
+
+    def claim_item(self, key, owner, now, expires):
+        """
+        Reserva para 'owner' hasta 'expires' un item pendiente de publicar
+        (alert_state = ALERT_PENDING) cuya reserva ha caducado; devuelve True
+        si lo ha reservado.
+        """
+        def update(item):
+            if item is None or item.get('alert_state') != ALERT_PENDING or item['claim_expires'] >= now:
+                return item, False
+            item['claim_owner'] = owner
+            item['claim_expires'] = expires
+            return item, True
+
+        return self._update_item(key, update)
+
+    def release_claim(self, key, owner):
+        """Anula la reserva de 'owner' sobre el item, que sigue pendiente."""
+        def update(item):
+            if item is None or item.get('claim_owner') != owner:
+                return item, False
+            item['claim_expires'] = 0
+            return item, True
+
+        return self._update_item(key, update)
+
+    def insert_item(self, item):
+        """Escribe el item solo si su clave no existe; devuelve True si lo ha escrito."""
+        def update(current):
+            if current is not None:
+                return current, False
+            return dict(item), True
+
+        return self._update_item(item['monthYear'], update)
+
+    def release_lease(self, lease_key, owner, force=False):
+        """
+        Libera el lease de 'owner'. Sin 'force' solo lo libera si no quedan
+        claves pendientes; devuelve False si no se ha liberado.
+        """
+        def update(item):
+            if item is None or item.get('lease_owner') != owner:
+                return item, False
+            if item.get('pending_keys') and not force:
+                return item, False
+            del item['lease_owner'], item['lease_expires']
+            return (item if item.get('pending_keys') else None), True
+
+        return self._update_item(lease_key, update)
+
+
+def empty_read_summary():
+    return {'read_requests': 0, 'read_retries': 0, 'consumed_read_capacity': 0.0}
+
+
+def local_write_summary(items):
+    return {
+        'items_written': len(items),
+        'write_batches': 1 if items else 0,
+        'write_requests': 1 if items else 0,
+        'write_retries': 0,
+        'consumed_write_capacity': 0.0
+    }
+
+
+def encode_local_item(item):
+    """Item -> JSON con los tipos de DynamoDB (S, N, SS) para SQLiteSink."""
+    encoded = {}
+    for name, value in item.items():
+        if isinstance(value, str):
+            encoded[name] = {'S': value}
+        elif isinstance(value, (set, frozenset)):
+            encoded[name] = {'SS': sorted(value)}
+        else:
+            encoded[name] = {'N': str(value)}
+    return json.dumps(encoded)
+
+
+def decode_local_item(raw_item):
+    """Inversa de encode_local_item (los números como Decimal)."""
+    item = {}
+    for name, value in json.loads(raw_item).items():
+        if 'N' in value:
+            item[name] = Decimal(value['N'])
+        elif 'SS' in value:
+            item[name] = set(value['SS'])
+        else:
+            item[name] = value['S']
+    return item
+
+
+def project_item(item, projection):
+    """Aplica una ProjectionExpression simple ('a, b, c') a un item."""
+    if not projection:
+        return dict(item)
+    names = [name.strip() for name in projection.split(',')]
+    return {name: item[name] for name in names if name in item}
+
+
+class DynamoDBSink(AggregateSink):
+    """
+    Tabla DynamoDB (default: DYNAMODB_TABLE). El lease y el registro de
+    alarmas usan escrituras condicionales (PutItem / UpdateItem / DeleteItem
+    con ConditionExpression) sobre la tabla CONTROL_TABLE.
+    """
+
+    def __init__(self, table_name=None):
+        self.table_name = table_name
+        self._control = None
+
+    def _table_name(self):
+        return self.table_name or get_table_name()
+
+    def control_sink(self):
+        if self._control is None:
+            self._control = DynamoDBSink(get_control_table_name())
+        return self._control
+
+    def get_items(self, month_keys, projection=None):
+        return batch_get_items(month_keys, projection, table_name=self._table_name())
+
+    def put_items(self, items):
+        return batch_write_items(items, table_name=self._table_name())
+
+    def delete_items(self, month_keys):
+        for key in month_keys:
+            self._conditional('delete_item', key)
+
+    def _conditional(self, operation, lease_key, **kwargs):
+        """Ejecuta la operación; devuelve su respuesta o None si falla la condición."""
+        client = get_dynamodb_client()
+        try:
+            return getattr(client, operation)(
+                TableName=self._table_name(), Key={'monthYear': {'S': lease_key}}, **kwargs
+            )
+        except client.exceptions.ConditionalCheckFailedException:
+            return None
+
+    def add_pending(self, lease_key, entries):
+        self._conditional(
+            'update_item', lease_key,
+            UpdateExpression='ADD pending_keys :entries',
+            ExpressionAttributeValues={':entries': {'SS': sorted(set(entries))}}
+        )
+
+    def acquire_lease(self, lease_key, owner, now, expires):
+        return self._conditional(
+            'update_item', lease_key,
+            UpdateExpression='SET lease_owner = :owner, lease_expires = :expires',
+            ConditionExpression='attribute_not_exists(lease_owner) OR lease_owner = :owner OR lease_expires < :now',
+            ExpressionAttributeValues={
+                ':owner': {'S': owner}, ':expires': {'N': str(expires)}, ':now': {'N': str(now)}
             }
-        
-        # ============================================================
-        # PASO 2: Procesar todos los archivos y fusionar datos
-        # ============================================================
-        merged_daily_data = {}  # {'2023-01-15': {'temp': 20, 'sd': 0.5, 'source': 'file.csv', 'adjusted_month': '2023-01'}}
-        alerts_sent = 0
-        total_rows = 0
-        files_processed = 0
-        month_adjustments = 0  # Contador de fechas ajustadas
-        
-        for csv_key in all_csv_files:
-            file_data = process_csv_file(bucket, csv_key, local_dir)
-            
-            if file_data:
-                files_processed += 1
-                total_rows += len(file_data)
-                
-                # Fusionar: última aparición sobrescribe
-                for fecha, data in file_data.items():
-
-                    # Verificar si se ajustó el mes
-                    fecha_dt = datetime.strptime(fecha, '%Y-%m-%d')
-                    original_month = fecha_dt.strftime('%Y-%m')
-                    if data['adjusted_month'] != original_month:
-                        month_adjustments += 1
-                    
-                    merged_daily_data[fecha] = data
-                    
-                    # Detectar alertas
-                    if data['sd'] > DEVIATION_THRESHOLD:
-                        send_alert(fecha.replace('-', '/'), data['sd'], data['temp'], csv_key)
-                        alerts_sent += 1
-        
-        duplicates_found = total_rows - len(merged_daily_data)
-        
-        # ============================================================
-        # PASO 3: Agrupar por mes AJUSTADO y calcular métricas
-        # ============================================================
-        monthly_data = defaultdict(dict)  # {'2023-01': {'2023-01-05': {...}, ...}}
-        
-        for fecha_str, data in merged_daily_data.items():
-            # Usar el mes ajustado en lugar del mes natural
-            mes = data['adjusted_month']
-            monthly_data[mes][fecha_str] = data
-        
-        # ============================================================
-        # PASO 4: Actualizar DynamoDB
-        # ============================================================
-        updated_months = 0
-        
-        for mes, dates_dict in sorted(monthly_data.items()):
-            try:
-                # Calcular métricas del mes
-                all_temps = [d['temp'] for d in dates_dict.values()]
-                all_sds = [d['sd'] for d in dates_dict.values()]
-                
-                max_temp = max(all_temps)
-                max_sd = max(all_sds)
-                mean_temp = round_decimal(sum(all_temps) / len(all_temps))
-                count = len(all_temps)
-
-                # Calcular diferencia con mes anterior
-                current_month_dt = datetime.strptime(mes, '%Y-%m')
-                previous_month_dt = current_month_dt.replace(day=1) - timedelta(days=1)
-                previous_month = previous_month_dt.strftime('%Y-%m')
-
-                # Buscar mes anterior en datos procesados o DB
-                if previous_month in monthly_data:
-                    prev_temps = [d['temp'] for d in monthly_data[previous_month].values()]
-                    prev_max = max(prev_temps)
-                else:
-                    # Buscar en DynamoDB
-                    previous_item_resp = table.get_item(Key={'monthYear': previous_month})
-                    previous_item = previous_item_resp.get('Item', {})
-                    prev_max = Decimal(str(previous_item.get('max_temp', 0)))
-
-                max_diff_temp = round_decimal(max_temp - prev_max)
-
-                # Guardar en DynamoDB
-                table.put_item(
-                    Item={
-                        'monthYear': mes,
-                        'max_temp': max_temp,
-                        'max_sd': max_sd,
-                        'mean_temp': mean_temp,
-                        'max_diff_temp': max_diff_temp,
-                        'mean_temp_count': count,
-                        'last_updated': datetime.now().isoformat()
-                    }
+        ) is not None
+
+    def take_pending(self, lease_key, owner):
+        response = self._conditional(
+            'update_item', lease_key,
+            UpdateExpression='REMOVE pending_keys',
+            ConditionExpression='lease_owner = :owner',
+            ExpressionAttributeValues={':owner': {'S': owner}},
+            ReturnValues='UPDATED_OLD'
+        )
+        if response is None:
+            return None
+        return sorted(response.get('Attributes', {}).get('pending_keys', {}).get('SS', []))
+
+    def query_items(self, index, attribute, value):
+        client = get_dynamodb_client()
+        _, deserializer = get_dynamodb_types()
+        request = {
+            'TableName': self._table_name(),
+            'IndexName': index,
+            'KeyConditionExpression': f'{attribute} = :value',
+            'ExpressionAttributeValues': {':value': {'S': value}},
+            'ReturnConsumedCapacity': 'TOTAL'
+        }
+        items = []
+        summary = empty_read_summary()
+
+        while True:
+            response = client.query(**request)
+            summary['read_requests'] += 1
+            summary['consumed_read_capacity'] += response.get('ConsumedCapacity', {}).get('CapacityUnits', 0)
+            for raw_item in response.get('Items', []):
+                items.append({name: deserializer.deserialize(value) for name, value in raw_item.items()})
+            if 'LastEvaluatedKey' not in response:
+                return items, summary
+            request['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def claim_item(self, key, owner, now, expires):
+        return self._conditional(
+            'update_item', key,
+            UpdateExpression='SET claim_owner = :owner, claim_expires = :expires',
+            ConditionExpression='alert_state = :pending AND claim_expires < :now',
+            ExpressionAttributeValues={
+                ':owner': {'S': owner}, ':expires': {'N': str(expires)}, ':now': {'N': str(now)},
+                ':pending': {'S': ALERT_PENDING}
+            }
+        ) is not None
+
+    def release_claim(self, key, owner):
+        return self._conditional(
+            'update_item', key,
+            UpdateExpression='SET claim_expires = :zero',
+            ConditionExpression='claim_owner = :owner',
+            ExpressionAttributeValues={':owner': {'S': owner}, ':zero': {'N': '0'}}
+        ) is not None
+
+    def insert_item(self, item):
+        serializer, _ = get_dynamodb_types()
+        client = get_dynamodb_client()
+        try:
+            client.put_item(
+                TableName=self._table_name(),
+                Item={name: serializer.serialize(value) for name, value in item.items()},
+                ConditionExpression='attribute_not_exists(monthYear)'
+            )
+        except client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def release_lease(self, lease_key, owner, force=False):
+        if force:
+            # Las claves pendientes se quedan en el item para el siguiente evento
+            response = self._conditional(
+                'update_item', lease_key,
+                UpdateExpression='REMOVE lease_owner, lease_expires',
+                ConditionExpression='lease_owner = :owner',
+                ExpressionAttributeValues={':owner': {'S': owner}}
+            )
+        else:
+            response = self._conditional(
+                'delete_item', lease_key,
+                ConditionExpression='lease_owner = :owner AND attribute_not_exists(pending_keys)',
+                ExpressionAttributeValues={':owner': {'S': owner}}
+            )
+        return response is not None
+
+
+class SQLiteSink(AggregateSink):
+    """
+    Tabla SQLite (monthYear -> item). Los números se guardan como texto y se
+    devuelven como Decimal, igual que los lee DynamoDB. Los items de control
+    van a la tabla 'control' de la misma base.
+    """
+
+    def __init__(self, path, table="measures"):
+        import sqlite3
+        self.path = path
+        self.table = table
+        self._sqlite3 = sqlite3
+        self._control = None
+        with self._connect() as connection:
+            connection.execute(f"CREATE TABLE IF NOT EXISTS {table} (monthYear TEXT PRIMARY KEY, item TEXT NOT NULL)")
+
+    def control_sink(self):
+        if self._control is None:
+            self._control = SQLiteSink(self.path, table="control")
+        return self._control
+
+    def _connect(self):
+        return self._sqlite3.connect(self.path)
+
+    def get_items(self, month_keys, projection=None):
+        month_keys = sorted(set(month_keys))
+        items = {}
+
+        with self._connect() as connection:
+            for i in range(0, len(month_keys), BATCH_GET_SIZE):
+                chunk = month_keys[i:i + BATCH_GET_SIZE]
+                rows = connection.execute(
+                    f"SELECT item FROM {self.table} WHERE monthYear IN ({','.join('?' * len(chunk))})", chunk
                 )
+                for (raw_item,) in rows:
+                    item = decode_local_item(raw_item)
+                    items[item['monthYear']] = project_item(item, projection)
 
-                updated_months += 1
+        return items, empty_read_summary()
 
-            except Exception as e:
-                print(f"Error updating month {mes}: {e}")
-                raise
-        
-        return {
-            "statusCode": 200,
-            "body": json.dumps({
-                "message": "Processing completed successfully",
-                "trigger_file": trigger_key,
-                "files_processed": files_processed,
-                "total_rows": total_rows,
-                "unique_dates": len(merged_daily_data),
-                "duplicates_overwritten": duplicates_found,
-                "month_adjustments": month_adjustments,
-                "months_updated": updated_months,
-                "alerts_sent": alerts_sent
-            })
+    def put_items(self, items):
+        rows = [(item['monthYear'], encode_local_item(item)) for item in items]
+
+        with self._connect() as connection:
+            connection.executemany(f"INSERT OR REPLACE INTO {self.table} (monthYear, item) VALUES (?, ?)", rows)
+
+        return local_write_summary(items)
+
+    def query_items(self, index, attribute, value):
+        with self._connect() as connection:
+            rows = connection.execute(f"SELECT item FROM {self.table}").fetchall()
+        items = [decode_local_item(raw_item) for (raw_item,) in rows]
+        return [item for item in items if item.get(attribute) == value], empty_read_summary()
+
+    def _update_item(self, key, update):
+        connection = self._connect()
+        try:
+            # BEGIN IMMEDIATE bloquea la base entre la lectura y la escritura
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(f"SELECT item FROM {self.table} WHERE monthYear = ?", (key,)).fetchone()
+            item, result = update(decode_local_item(row[0]) if row else None)
+            if item is None:
+                connection.execute(f"DELETE FROM {self.table} WHERE monthYear = ?", (key,))
+            else:
+                connection.execute(f"INSERT OR REPLACE INTO {self.table} (monthYear, item) VALUES (?, ?)",
+                                   (key, encode_local_item(item)))
+            connection.commit()
+            return result
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+
+class MemorySink(AggregateSink):
+    """Agregados en un dict {monthYear: item}; los items de control en otro MemorySink."""
+
+    def __init__(self):
+        self.items = {}
+        self._lock = threading.Lock()
+        self._control = None
+
+    def control_sink(self):
+        with self._lock:
+            if self._control is None:
+                self._control = MemorySink()
+        return self._control
+
+    def get_items(self, month_keys, projection=None):
+        items = {
+            mes: project_item(self.items[mes], projection)
+            for mes in set(month_keys) if mes in self.items
         }
+        return items, empty_read_summary()
 
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        raise Exception(f"Error processing bucket {bucket}: {str(e)}")
\ No newline at end of file
+    def put_items(self, items):
+        for item in items:
+            self.items[item['monthYear']] = dict(item)
+        return local_write_summary(items)
+
+    def query_items(self, index, attribute, value):
+        with self._lock:
+            items = [dict(item) for item in self.items.values() if item.get(attribute) == value]
+        return items, empty_read_summary()
+
+    def _update_item(self, key, update):
+        with self._lock:
+            current = self.items.get(key)
+            if current is not None:
+                current = {name: set(value) if isinstance(value, set) else value for name, value in current.items()}
+            item, result = update(current)
+            if item is None:
+                self.items.pop(key, None)
+            else:
+                self.items[key] = item
+            return result
+
+
+class AlertNotifier:
+    """Canal de publicación de las alarmas."""
+
+    def publish(self, subject, message):
+        raise NotImplementedError
+
+
+class SNSNotifier(AlertNotifier):
+
+    def publish(self, subject, message):
+        get_sns_client().publish(
+            TopicArn=get_sns_topic_arn(),
+            Subject=subject,
+            Message=message
+        )
+
+
+class MemoryNotifier(AlertNotifier):
+    """Guarda los mensajes en una lista [(asunto, mensaje)] en lugar de enviarlos."""
+
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, subject, message):
+        self.messages.append((subject, message))
+
+
+_backends = {}
+
+
+def configure_backends(source=None, sink=None, notifier=None):
+    """
+    Fija los backends a usar (las herramientas offline inyectan así los suyos).
+    Los que no se pasan se vuelven a crear a partir de las variables de entorno.
+    """
+    _backends.clear()
+    for name, backend in (('source', source), ('sink', sink), ('notifier', notifier)):
+        if backend is not None:
+            _backends[name] = backend
+
+
+def get_object_source():
+    source = _backends.get('source')
+    if source is None:
+        if SOURCE_BACKEND == "s3":
+            source = S3ObjectSource()
+        elif SOURCE_BACKEND == "local":
+            source = LocalObjectSource(LOCAL_SOURCE_DIR)
+        elif SOURCE_BACKEND == "memory":
+            source = MemoryObjectSource()
+        else:
+            raise ValueError(f"Unknown SOURCE_BACKEND: {SOURCE_BACKEND}")
+        _backends['source'] = source
+    return source
+
+
+def get_aggregate_sink():
+    sink = _backends.get('sink')
+    if sink is None:
+        if SINK_BACKEND == "dynamodb":
+            sink = DynamoDBSink()
+        elif SINK_BACKEND == "sqlite":
+            sink = SQLiteSink(SQLITE_PATH)
+        elif SINK_BACKEND == "memory":
+            sink = MemorySink()
+        else:
+            raise ValueError(f"Unknown SINK_BACKEND: {SINK_BACKEND}")
+        _backends['sink'] = sink
+    return sink
+
+
+def get_control_sink():
+    """Destino de los items de control (lease, registro de alarmas, marcadores)."""
+    control = _backends.get('control')
+    if control is None:
+        control = get_aggregate_sink().control_sink()
+        _backends['control'] = control
+    return control
+
+
+def get_notifier():
+    notifier = _backends.get('notifier')
+    if notifier is None:
+        if ALERT_BACKEND == "sns":
+            notifier = SNSNotifier()
+        elif ALERT_BACKEND == "memory":
+            notifier = MemoryNotifier()
+        else:
+            raise ValueError(f"Unknown ALERT_BACKEND: {ALERT_BACKEND}")
+        _backends['notifier'] = notifier
+    return notifier
+
+
+# ============================================================================
+# MÉTRICAS DE LA INVOCACIÓN (TIEMPOS POR ETAPA Y CONTADORES DE E/S)
+# ============================================================================
+
+class InvocationMetrics:
+    """
+    Tiempo de pared por etapa y contadores de E/S de una invocación.
+
+    Los contadores de S3 cuentan las llamadas al origen de objetos
+    configurado y los de DynamoDB las peticiones al destino de agregados.
+    io_ms acumula el tiempo bloqueado en cada servicio sumando todos los
+    hilos: comparado con wall_ms y cpu_ms indica si la invocación estuvo
+    limitada por S3, por DynamoDB o por CPU.
+    """
+
+    COUNTERS = (
+        's3_list_calls', 's3_get_calls', 's3_put_calls', 'bytes_read',
+        'compressed_bytes_read', 'decompressed_bytes',
+        'dynamodb_read_requests', 'dynamodb_write_requests',
+        'consumed_read_capacity', 'consumed_write_capacity', 'lease_requests', 'sns_publishes'
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self._cpu_started = time.process_time()
+        self.stages = {}
+        self.io_seconds = {'s3': 0.0, 'dynamodb': 0.0, 'sns': 0.0}
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def add_io_time(self, service, seconds):
+        with self._lock:
+            self.io_seconds[service] += seconds
+
+    def add_stage_time(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, stage):
+        """Acumula en la etapa el tiempo de pared del bloque."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_time(stage, time.perf_counter() - start)
+
+    @contextmanager
+    def io(self, service):
+        """Acumula en el servicio el tiempo bloqueado en el bloque."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_io_time(service, time.perf_counter() - start)
+
+    def snapshot(self):
+        """Resumen serializable en JSON (tiempos en milisegundos)."""
+        with self._lock:
+            return {
+                'wall_ms': round((time.perf_counter() - self._started) * 1000, 3),
+                'cpu_ms': round((time.process_time() - self._cpu_started) * 1000, 3),
+                'stages_ms': {stage: round(seconds * 1000, 3) for stage, seconds in self.stages.items()},
+                'io_ms': {service: round(seconds * 1000, 3) for service, seconds in self.io_seconds.items()},
+                **self.counters
+            }
+
+
+class CountingReader(io.RawIOBase):
+    """
+    Envuelve el cuerpo de un objeto contando los bytes leídos y el tiempo de
+    lectura. Con keep_edges guarda también los primeros y los últimos
+    TAIL_WINDOW_BYTES bytes leídos y el SHA-256 de todo lo leído (ver
+    csv_boundary).
+    """
+
+    def __init__(self, body, metrics, keep_edges=False):
+        self._body = body
+        self._metrics = metrics
+        self.size = 0
+        self.head = b'' if keep_edges else None
+        self.window = b'' if keep_edges else None
+        self.digest = hashlib.sha256() if keep_edges else None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        with self._metrics.io('s3'):
+            data = self._body.read(len(buffer))
+        size = len(data)
+        buffer[:size] = data
+        self._metrics.count('bytes_read', size)
+
+        self.size += size
+        if self.head is not None and size:
+            if len(self.head) < TAIL_WINDOW_BYTES:
+                self.head += data[:TAIL_WINDOW_BYTES - len(self.head)]
+            self.window = (self.window + data)[-TAIL_WINDOW_BYTES:]
+            self.digest.update(data)
+
+        return size
+
+
+_metrics = InvocationMetrics()
+
+
+def get_metrics():
+    """Métricas de la invocación en curso."""
+    return _metrics
+
+
+def reset_metrics():
+    """Empieza a medir una invocación nueva."""
+    global _metrics
+    _metrics = InvocationMetrics()
+    return _metrics
+
+
+# ============================================================================
+# FUNCIONES AUXILIARES
+# ============================================================================
+
+def round_decimal(value):
+    """Redondea un valor Decimal a 4 decimales."""
+    return value.quantize(Decimal("0.0001"))
+
+@lru_cache(maxsize=4096)
+def adjust_month_for_date(fecha_dt):
+    """
+    Ajusta el mes de una fecha según el día.
+    Si el día es <= 3, se asigna al mes anterior.
+    Memoizada: el mismo día aparece en muchos archivos.
+    
+    Args:
+        fecha_dt: datetime o date
+    
+    Returns:
+        str: Mes en formato 'YYYY-MM' ajustado
+    """
+    if fecha_dt.day <= 3:
+        # Mover al mes anterior
+        adjusted_date = fecha_dt.replace(day=1) - timedelta(days=1)
+        return adjusted_date.strftime('%Y-%m')
+    else:
+        return fecha_dt.strftime('%Y-%m')
+
+# 'YYYY/MM/DD' o 'YYYY-MM-DD' (mes y día pueden no llevar cero a la izquierda;
+# como en strptime, el día también admite un espacio delante)
+FECHA_PATTERN = re.compile(r'(\d{4})([/-])(\d{1,2})\2(\d{1,2}| \d)')
+
+
+@lru_cache(maxsize=8192)
+def parse_fecha(fecha_raw):
+    """
+    Parser rápido de fechas para el bucle de ingesta.
+
+    Acepta los formatos '%Y/%m/%d' y '%Y-%m-%d' de strptime (mes y día con
+    o sin cero a la izquierda) y calcula en la misma pasada el mes ajustado,
+    de modo que ninguna fecha se vuelve a parsear más adelante.
+
+    Args:
+        fecha_raw: Texto de la columna 'Fecha'
+
+    Returns:
+        tuple: (fecha 'YYYY-MM-DD', mes ajustado 'YYYY-MM', True si se ajustó el mes)
+        None: si la fecha no es válida
+    """
+    match = FECHA_PATTERN.fullmatch(fecha_raw)
+    if match is None:
+        return None
+
+    try:
+        fecha = date(int(match.group(1)), int(match.group(3)), int(match.group(4)))
+    except ValueError:
+        return None
+
+    fecha_str = fecha.isoformat()
+    adjusted_month = adjust_month_for_date(fecha)
+
+    return fecha_str, adjusted_month, adjusted_month != fecha_str[:7]
+
+
+@lru_cache(maxsize=8192)
+def parse_fecha_ordinal(fecha_raw):
+    """
+    Igual que parse_fecha pero en la forma columnar de DailySeries.
+
+    Returns:
+        tuple: (date.toordinal(), id del mes ajustado, True si se ajustó el mes)
+        None: si la fecha no es válida
+    """
+    parsed = parse_fecha(fecha_raw)
+    if parsed is None:
+        return None
+
+    fecha_str, adjusted_month, month_adjusted = parsed
+    return date.fromisoformat(fecha_str).toordinal(), month_id_of(adjusted_month), month_adjusted
+
+def send_alert(fecha_str, desviacion, temp_media, filename):
+    """Envía una alerta por SNS. Devuelve True si se ha publicado."""
+    try:
+        fecha_dt = datetime.strptime(fecha_str, '%Y/%m/%d')
+        fecha_formatted = fecha_dt.strftime("%Y-%m-%d")
+        
+        subject = "⚠️ Alarma Mar Menor - Desviación Alta Detectada"
+        message = f"""
+⚠️ ALERTA DE TEMPERATURA - MAR MENOR
+=========================================
+Se ha detectado una desviación superior al umbral.
+
+📊 DETALLES
+-----------------------------------------
+- Fecha:        {fecha_formatted}
+- Desviación:   {float(desviacion):.4f}°C ⚠️
+- Umbral:       {float(DEVIATION_THRESHOLD):.2f}°C
+- Temp Media:   {float(temp_media):.2f}°C
+- Archivo:      {filename}
+
+--
+Sistema AquaSenseCloud
+        """.strip()
+
+        with get_metrics().io('sns'):
+            get_notifier().publish(subject, message)
+        get_metrics().count('sns_publishes')
+        return True
+    except Exception as e:
+        print(f"Error enviando alerta SNS: {str(e)}")
+        return False
+
+
+def send_alert_digest(alerts):
+    """
+    Envía en un único mensaje SNS un resumen con varias alarmas.
+
+    Args:
+        alerts: Lista de {'fecha': 'YYYY-MM-DD', 'sd': Decimal, 'temp': Decimal, 'source': str}
+
+    Returns:
+        bool: True si se ha publicado
+    """
+    if len(alerts) == 1:
+        alert = alerts[0]
+        return send_alert(alert['fecha'].replace('-', '/'), alert['sd'], alert['temp'], alert['source'])
+
+    try:
+        lines = [
+            f"- {alert['fecha']}   Desv: {float(alert['sd']):.4f}°C   "
+            f"Temp: {float(alert['temp']):.2f}°C   ({alert['source']})"
+            for alert in alerts
+        ]
+
+        subject = f"⚠️ Alarma Mar Menor - {len(alerts)} Desviaciones Altas Detectadas"
+        message = f"""
+⚠️ ALERTAS DE TEMPERATURA - MAR MENOR
+=========================================
+Se han detectado {len(alerts)} desviaciones superiores al umbral
+({float(DEVIATION_THRESHOLD):.2f}°C).
+
+📊 DETALLES
+-----------------------------------------
+{chr(10).join(lines)}
+
+--
+Sistema AquaSenseCloud
+        """.strip()
+
+        with get_metrics().io('sns'):
+            get_notifier().publish(subject, message)
+        get_metrics().count('sns_publishes')
+        return True
+    except Exception as e:
+        print(f"Error enviando resumen de alertas SNS: {str(e)}")
+        return False
+
+
+def iter_csv_objects(bucket, prefix="", listing_stats=None, archived=None):
+    """
+    Lista de forma paginada los archivos CSV del bucket.
+
+    Sigue NextContinuationToken mientras IsTruncated sea True, por lo que no
+    se pierden objetos a partir de 1000 claves. Las claves se devuelven a
+    medida que llega cada página (S3 ya las entrega en orden alfabético),
+    así el procesado puede empezar antes de terminar el listado.
+
+    Args:
+        bucket: Nombre del bucket
+        prefix: Prefijo opcional para filtrar las claves
+        listing_stats: dict opcional donde se acumulan 'list_pages' y 'listed_keys'
+        archived: set opcional donde se añaden las claves originales de los CSV archivados
+
+    Yields:
+        dict: Entrada del listado de cada archivo CSV ('Key', 'ETag', 'Size', ...)
+    """
+    if listing_stats is None:
+        listing_stats = {}
+    listing_stats.setdefault('list_pages', 0)
+    listing_stats.setdefault('listed_keys', 0)
+
+    source = get_object_source()
+    metrics = get_metrics()
+    continuation_token = None
+
+    while True:
+        try:
+            metrics.count('s3_list_calls')
+            with metrics.io('s3'):
+                response = source.list_objects(bucket, prefix, continuation_token)
+        except Exception as e:
+            print(f"Error listing bucket contents: {e}")
+            raise
+
+        listing_stats['list_pages'] += 1
+
+        for obj in response.get('Contents', []):
+            listing_stats['listed_keys'] += 1
+
+            # Filtrar solo CSVs (los archivados por la compactación no cuentan)
+            if not is_csv_key(obj['Key']):
+                continue
+            if not is_archived_key(obj['Key']):
+                yield obj
+            elif archived is not None:
+                archived.add(original_key(obj['Key']))
+
+        if not response.get('IsTruncated'):
+            break
+
+        continuation_token = response['NextContinuationToken']
+
+
+def is_csv_key(key):
+    """True si la clave es un CSV, sin comprimir o comprimido (ver CSV_COMPRESSIONS)."""
+    return key.lower().endswith(tuple(CSV_COMPRESSIONS))
+
+
+def csv_compression(key):
+    """Compresión de un CSV según su extensión: None, 'gzip' o 'zstd'."""
+    lowered = key.lower()
+    for suffix, compression in CSV_COMPRESSIONS.items():
+        if compression is not None and lowered.endswith(suffix):
+            return compression
+    return None
+
+
+def is_compacted_key(key):
+    """True si la clave es un CSV escrito por la compactación (no dispara pasadas)."""
+    return COMPACTED_PREFIX != INPUT_PREFIX and key.startswith(COMPACTED_PREFIX)
+
+
+def is_archived_key(key):
+    """True si la clave es un CSV ya archivado por la compactación."""
+    return ARCHIVE_PREFIX != INPUT_PREFIX and key.startswith(ARCHIVE_PREFIX)
+
+
+def archived_key(key):
+    """Clave con la que la compactación archiva un CSV de INPUT_PREFIX."""
+    return f"{ARCHIVE_PREFIX}{key[len(INPUT_PREFIX):]}"
+
+
+def original_key(key):
+    """Inversa de archived_key."""
+    return f"{INPUT_PREFIX}{key[len(ARCHIVE_PREFIX):]}"
+
+
+def iter_csv_keys(bucket, prefix="", listing_stats=None):
+    """Igual que iter_csv_objects pero devolviendo solo las claves."""
+    for obj in iter_csv_objects(bucket, prefix, listing_stats):
+        yield obj['Key']
+
+
+def process_csv_file(bucket, key):
+    """
+    Lee y procesa un archivo CSV directamente desde el origen de objetos.
+
+    Returns:
+        DailySeries: Una fila por fecha (vacía si el archivo falla)
+    """
+    return read_csv_object(bucket, key)[0]
+
+
+def read_csv_object(bucket, key, boundaries=None, retired=None, by_origin=False):
+    """
+    Igual que process_csv_file, devolviendo también el ETag del objeto leído.
+
+    El cuerpo del objeto (get_object en S3) se decodifica y se parsea línea a
+    línea según llega, sin escribir el archivo en /tmp. Los *.csv.gz y
+    *.csv.zst se descomprimen también en streaming. Si se pasa 'boundaries',
+    se guarda en boundaries[clave] la frontera del objeto (ver csv_boundary)
+    para leer después solo lo que se le añada (solo sin comprimir).
+    'retired' y 'by_origin' se pasan a parse_csv_rows.
+
+    Returns:
+        tuple: (DailySeries, ETag); (DailySeries vacía, None) si el archivo falla
+    """
+    body = None
+    compression = csv_compression(key)
+    if compression is not None:
+        boundaries = None
+
+    try:
+        metrics = get_metrics()
+        metrics.count('s3_get_calls')
+        with metrics.io('s3'):
+            body, etag = get_object_source().open_object(bucket, key)
+        counting_body = CountingReader(body, metrics, keep_edges=boundaries is not None)
+        stream = io.BufferedReader(counting_body)
+        if compression is not None:
+            stream = open_decompressed(stream, compression)
+        csvfile = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+
+        daily_data = parse_csv_rows(key, csvfile, retired, by_origin)
+
+        if compression is not None:
+            metrics.count('compressed_bytes_read', counting_body.size)
+            metrics.count('decompressed_bytes', stream.tell())
+
+        if boundaries is not None:
+            boundaries[key] = csv_boundary(counting_body.head, counting_body.window, counting_body.size,
+                                           counting_body.digest.hexdigest())
+
+        return daily_data, etag
+
+    except Exception as e:
+        print(f"Error processing file {key}: {e}")
+        return ({} if by_origin else DailySeries()), None
+
+    finally:
+        if body is not None:
+            body.close()
+
+
+def open_decompressed(stream, compression):
+    """
+    Envuelve un flujo binario comprimido ('gzip' o 'zstd') en otro que lo
+    descomprime a medida que se lee, sin cargar el objeto entero. Admite
+    varios miembros/frames concatenados (p. ej. subidas que se van añadiendo).
+
+    Raises:
+        RuntimeError: si el objeto es zstd y zstandard no está instalado
+    """
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+
+    zstandard = get_zstandard()
+    if zstandard is None:
+        raise RuntimeError("zstandard is not installed, cannot decompress .zst objects")
+    return zstandard.ZstdDecompressor().stream_reader(stream, read_across_frames=True)
+
+
+def parse_csv_rows(key, csvfile, retired=None, by_origin=False):
+    """
+    Parsea un CSV de temperatura (texto con cabecera) en una DailySeries.
+
+    Args:
+        key: Clave del archivo (origen de las filas sin columna 'Origen')
+        csvfile: Texto del CSV
+        retired: Orígenes cuyas filas se descartan (archivos compactados)
+        by_origin: Devolver una serie por origen en lugar de una sola
+
+    Returns:
+        DailySeries: Una fila por fecha (la última fila de cada fecha gana),
+                     o {origen: DailySeries} con by_origin
+    """
+    daily_data = DailySeries()
+    series_by_origin = {}
+    reader = csv.DictReader(csvfile, delimiter=',')
+
+    # Los archivos compactados conservan el origen de cada fila en 'Origen'
+    # (para que "última gana" siga comparando las claves originales)
+    has_origin = reader.fieldnames is not None and 'Origen' in reader.fieldnames
+
+    for row in reader:
+        # Parseo de fecha y ajuste de mes (si día <= 3, va al mes anterior)
+        parsed = parse_fecha_ordinal(row['Fecha'])
+        if parsed is None:
+            print(f"Warning: Invalid date format in {key}: {row['Fecha']}")
+            continue
+
+        ordinal, month_id, month_adjusted = parsed
+        temp_media = to_scaled(round_decimal(Decimal(row['Medias'])))
+        desviacion = to_scaled(round_decimal(Decimal(row['Desviaciones'])))
+
+        # Guardar (sobrescribe si ya existe en este archivo)
+        source = row['Origen'] if has_origin and row['Origen'] else key
+        if retired and source in retired:
+            continue
+
+        if by_origin:
+            daily_data = series_by_origin.get(source)
+            if daily_data is None:
+                daily_data = series_by_origin[source] = DailySeries()
+        daily_data.upsert(ordinal, temp_media, desviacion, month_id, source, month_adjusted)
+
+    return series_by_origin if by_origin else daily_data
+
+
+def csv_boundary(head, window, size, prefix_sha):
+    """
+    Frontera de un CSV ya ingerido: [tamaño, línea de cabecera, tamaño de la
+    ventana, SHA-256 de la ventana, SHA-256 del objeto completo o None], donde
+    la ventana son sus últimos bytes.
+
+    Returns:
+        list: La frontera, o None si el objeto no termina en salto de línea
+              (la última fila podría estar a medias) o la cabecera no cabe en 'head'
+    """
+    if not window.endswith(b'\n') or b'\n' not in head:
+        return None
+
+    header = head[:head.index(b'\n') + 1]
+    return [size, header.decode('utf-8'), len(window), hashlib.sha256(window).hexdigest(), prefix_sha]
+
+
+def read_csv_tail(bucket, key, boundary):
+    """
+    Lee solo las filas añadidas por el final a un CSV ya ingerido.
+
+    Con TAIL_VERIFY='prefix' se descarga el objeto y se compara el SHA-256
+    de los bytes ya ingeridos con el de la frontera: la comprobación es
+    exacta y solo se parsea lo que sigue. Con TAIL_VERIFY='window' bastan
+    dos GET con rango (la cabecera y, desde el inicio de la ventana final
+    guardada, el resto del objeto), pero solo se comparan la cabecera y esa
+    ventana: una edición anterior a la ventana que no cambie el tamaño no
+    se detecta. Las filas nuevas se parsean con la cabecera guardada.
+
+    Returns:
+        tuple: (DailySeries de las filas añadidas, ETag, frontera nueva o None)
+        None: si no es una ampliación de la versión ingerida (hay que leerlo entero)
+    """
+    size, header, window_size, window_sha, prefix_sha = boundary
+    header_bytes = header.encode('utf-8')
+    source = get_object_source()
+    metrics = get_metrics()
+
+    def read_range(start=None, end=None):
+        metrics.count('s3_get_calls')
+        with metrics.io('s3'):
+            body, etag = source.open_object(bucket, key, start, end)
+            try:
+                data = body.read()
+            finally:
+                body.close()
+        metrics.count('bytes_read', len(data))
+        return data, etag
+
+    try:
+        if TAIL_VERIFY == "window":
+            head, head_etag = read_range(0, len(header_bytes) - 1)
+            if head != header_bytes:
+                return None
+
+            data, etag = read_range(size - window_size)
+            if (etag != head_etag or len(data) < window_size
+                    or hashlib.sha256(data[:window_size]).hexdigest() != window_sha):
+                return None
+
+            tail = data[window_size:]
+            new_size = size - window_size + len(data)
+            new_prefix_sha = None  # sin los bytes anteriores no se puede calcular
+        else:
+            if prefix_sha is None:
+                return None
+
+            data, etag = read_range()
+            digest = hashlib.sha256(memoryview(data)[:size])
+            if len(data) < size or digest.hexdigest() != prefix_sha:
+                return None
+
+            tail = data[size:]
+            digest.update(tail)
+            new_size = len(data)
+            new_prefix_sha = digest.hexdigest()
+
+        text = (header_bytes + tail).decode('utf-8')
+        daily_data = parse_csv_rows(key, io.StringIO(text, newline=''))
+
+    except Exception as e:
+        print(f"Warning: tail read of {key} failed, reading the whole object: {e}")
+        return None
+
+    return daily_data, etag, csv_boundary(header_bytes, data[-TAIL_WINDOW_BYTES:], new_size, new_prefix_sha)
+
+
+def read_csv_tails(bucket, keys, tails):
+    """
+    read_csv_tail de varias claves en paralelo.
+
+    Returns:
+        dict: {clave: (DailySeries, ETag, frontera)} de las que son ampliaciones
+    """
+    if not keys:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=min(FETCH_WORKERS, len(keys))) as executor:
+        results = list(executor.map(lambda key: read_csv_tail(bucket, key, tails[key]), keys))
+
+    return {key: result for key, result in zip(keys, results) if result is not None}
+
+
+def fetch_csv_files(bucket, objects, max_workers=None, manifest=None, boundaries=None, retired=None,
+                    by_origin=False):
+    """
+    Descarga y parsea archivos CSV en paralelo con un pool de hilos acotado.
+
+    Los resultados se devuelven en el MISMO orden que las claves de entrada,
+    de modo que la fusión posterior ("última gana") es idéntica a la del
+    procesado secuencial. Como mucho hay 2 * max_workers archivos en vuelo,
+    así que se puede consumir un listado paginado sin cargarlo entero.
+
+    Si se pasa un manifiesto, los objetos cuyo ETag coincide con el guardado
+    se sirven desde él sin GET ni parseo.
+
+    Args:
+        bucket: Nombre del bucket
+        objects: Iterable de claves CSV o de entradas del listado ({'Key', 'ETag'}), ordenadas
+        max_workers: Número de hilos (default: FETCH_WORKERS)
+        manifest: dict opcional {clave: {'etag': str, 'data': DailySeries}}
+        boundaries: dict opcional donde guardar la frontera de cada objeto leído
+        retired, by_origin: Ver parse_csv_rows (sin manifiesto)
+
+    Yields:
+        tuple: (clave, ETag (del listado o del GET) o None, DailySeries del archivo,
+                True si vino del manifiesto)
+    """
+    if max_workers is None:
+        max_workers = FETCH_WORKERS
+
+    def load(obj):
+        if isinstance(obj, str):
+            key, etag = obj, None
+        else:
+            key, etag = obj['Key'], obj.get('ETag')
+
+        entry = manifest.get(key) if manifest else None
+        if entry is not None and etag is not None and entry['etag'] == etag:
+            return key, etag, entry['data'], True
+
+        file_data, read_etag = read_csv_object(bucket, key, boundaries, retired, by_origin)
+        return key, etag or read_etag, file_data, False
+
+    if max_workers <= 1:
+        for obj in objects:
+            yield load(obj)
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = deque()
+
+        for obj in objects:
+            in_flight.append(executor.submit(load, obj))
+
+            if len(in_flight) >= 2 * max_workers:
+                yield in_flight.popleft().result()
+
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+# ============================================================================
+# SERIE DIARIA COMPACTA
+# ============================================================================
+
+# Los valores ya vienen redondeados a 4 decimales: se guardan y agregan como
+# enteros escalados (punto fijo), exactos igual que los Decimal originales.
+DECIMAL_SCALE = 10000
+
+
+def to_scaled(value):
+    """Decimal con 4 decimales -> entero escalado."""
+    return int(value.scaleb(4))
+
+
+def from_scaled(value):
+    """Entero escalado -> Decimal con 4 decimales."""
+    return Decimal(int(value)).scaleb(-4)
+
+
+def month_id_of(mes):
+    """'YYYY-MM' -> identificador entero consecutivo (año * 12 + mes - 1)."""
+    return int(mes[:4]) * 12 + int(mes[5:7]) - 1
+
+
+def month_of_id(month_id):
+    """Inversa de month_id_of."""
+    year, month = divmod(int(month_id), 12)
+    return f"{year:04d}-{month + 1:02d}"
+
+
+@lru_cache(maxsize=4096)
+def previous_month_of(mes):
+    """Devuelve el mes anterior a 'YYYY-MM' en el mismo formato."""
+    return month_of_id(month_id_of(mes) - 1)
+
+
+@lru_cache(maxsize=4096)
+def next_month_of(mes):
+    """Devuelve el mes siguiente a 'YYYY-MM' en el mismo formato."""
+    return month_of_id(month_id_of(mes) + 1)
+
+
+class DailySeries:
+    """
+    Serie diaria compacta: una fila por fecha en columnas paralelas de arrays
+    tipados, con los orígenes (claves S3) internados en una tabla.
+
+    Sustituye al dict de dicts {'2023-01-15': {'temp': Decimal, ...}}: cada
+    fila ocupa ~30 bytes en columnas y el índice fecha -> fila es un array
+    denso por día (4 bytes por día del rango cubierto), en lugar de un dict,
+    dos Decimal y varias cadenas por fecha.
+
+    Columnas:
+        ordinals:   fecha como date.toordinal()           (int32)
+        temps:      temperatura media escalada x10^4      (int64)
+        sds:        desviación escalada x10^4             (int64)
+        month_ids:  mes ajustado (año * 12 + mes - 1)     (int32)
+        source_ids: índice en 'sources' del archivo origen (uint32)
+        adjusted:   1 si el mes se ajustó al anterior      (uint8)
+    """
+
+    __slots__ = ('ordinals', 'temps', 'sds', 'month_ids', 'source_ids', 'adjusted',
+                 'sources', '_source_index', '_index', '_index_base')
+
+    COLUMNS = ('ordinals', 'temps', 'sds', 'month_ids', 'source_ids', 'adjusted')
+
+    def __init__(self):
+        self.ordinals = array('i')
+        self.temps = array('q')
+        self.sds = array('q')
+        self.month_ids = array('i')
+        self.source_ids = array('I')
+        self.adjusted = array('B')
+        self.sources = []
+        self._source_index = {}
+        self._index = array('i')  # (ordinal - _index_base) -> fila, -1 si no hay
+        self._index_base = 0
+
+    def __len__(self):
+        return len(self.ordinals)
+
+    def position_of(self, ordinal):
+        """Fila de una fecha (ordinal) o None si no está."""
+        offset = ordinal - self._index_base
+        if 0 <= offset < len(self._index):
+            position = self._index[offset]
+            if position >= 0:
+                return position
+        return None
+
+    def _set_position(self, ordinal, position):
+        if not self._index:
+            self._index_base = ordinal
+
+        offset = ordinal - self._index_base
+        if offset < 0:
+            self._index = array('i', [-1]) * (-offset) + self._index
+            self._index_base = ordinal
+            offset = 0
+        elif offset >= len(self._index):
+            self._index.extend(array('i', [-1]) * (offset - len(self._index) + 1))
+
+        self._index[offset] = position
+
+    def intern_source(self, source):
+        """Devuelve el índice de 'source' en la tabla de orígenes."""
+        source_id = self._source_index.get(source)
+        if source_id is None:
+            source_id = len(self.sources)
+            self.sources.append(source)
+            self._source_index[source] = source_id
+        return source_id
+
+    def has_source(self, source):
+        """True si alguna fila de la serie viene o ha venido de 'source'."""
+        return source in self._source_index
+
+    def upsert(self, ordinal, temp, sd, month_id, source, adjusted=False):
+        """
+        Inserta o sobrescribe una fecha (última gana).
+
+        Sobrescribe si 'source' va igual o después en orden alfabético que el
+        origen actual, que es el mismo resultado que recorrer los archivos
+        ordenados y sobrescribir siempre.
+
+        Returns:
+            bool: True si cambian los valores (temp/sd) de la fecha
+        """
+        position = self.position_of(ordinal)
+
+        if position is None:
+            self._set_position(ordinal, len(self.ordinals))
+            self.ordinals.append(ordinal)
+            self.temps.append(temp)
+            self.sds.append(sd)
+            self.month_ids.append(month_id)
+            self.source_ids.append(self.intern_source(source))
+            self.adjusted.append(1 if adjusted else 0)
+            return True
+
+        if source < self.sources[self.source_ids[position]]:
+            return False
+
+        changed = self.temps[position] != temp or self.sds[position] != sd
+        self.temps[position] = temp
+        self.sds[position] = sd
+        self.source_ids[position] = self.intern_source(source)
+        return changed
+
+    def merge(self, other):
+        """
+        Fusiona otra serie sobre esta (última gana).
+
+        Returns:
+            set: month_ids cuyos valores han cambiado
+        """
+        changed_month_ids = set()
+        other_sources = other.sources
+
+        for i in range(len(other)):
+            if self.upsert(other.ordinals[i], other.temps[i], other.sds[i], other.month_ids[i],
+                           other_sources[other.source_ids[i]], other.adjusted[i]):
+                changed_month_ids.add(other.month_ids[i])
+
+        return changed_month_ids
+
+    def changed_month_ids(self, other):
+        """
+        month_ids con alguna fecha distinta entre esta serie y 'other':
+        fechas que solo están en una de las dos o con otra temp/sd.
+        """
+        changed_month_ids = set()
+
+        for position in range(len(self)):
+            other_position = other.position_of(self.ordinals[position])
+            if (other_position is None
+                    or other.temps[other_position] != self.temps[position]
+                    or other.sds[other_position] != self.sds[position]):
+                changed_month_ids.add(self.month_ids[position])
+
+        for position in range(len(other)):
+            if self.position_of(other.ordinals[position]) is None:
+                changed_month_ids.add(other.month_ids[position])
+
+        return changed_month_ids
+
+    def month_adjustments(self):
+        """Número de fechas asignadas a un mes distinto del natural."""
+        return sum(self.adjusted)
+
+    def fecha(self, position):
+        """Fecha 'YYYY-MM-DD' de una fila."""
+        return date.fromordinal(self.ordinals[position]).isoformat()
+
+    def source(self, position):
+        """Archivo origen de una fila."""
+        return self.sources[self.source_ids[position]]
+
+    def to_raw(self, include_source=True):
+        """Dict serializable en JSON: {'YYYY-MM-DD': {'temp', 'sd', 'adjusted_month'[, 'source']}}."""
+        raw_data = {}
+
+        for position in sorted(range(len(self)), key=self.ordinals.__getitem__):
+            entry = {
+                'temp': str(from_scaled(self.temps[position])),
+                'sd': str(from_scaled(self.sds[position])),
+                'adjusted_month': month_of_id(self.month_ids[position])
+            }
+            if include_source:
+                entry['source'] = self.source(position)
+            raw_data[self.fecha(position)] = entry
+
+        return raw_data
+
+    def columns(self):
+        """{nombre: array} de las columnas, en el orden de COLUMNS."""
+        return {name: getattr(self, name) for name in self.COLUMNS}
+
+    @classmethod
+    def from_columns(cls, columns, sources):
+        """Reconstruye la serie a partir de sus columnas (sin copiarlas) y su tabla de orígenes."""
+        series = cls()
+        for name in cls.COLUMNS:
+            setattr(series, name, columns[name])
+
+        series.sources = list(sources)
+        series._source_index = {source: source_id for source_id, source in enumerate(series.sources)}
+
+        if series.ordinals:
+            base = min(series.ordinals)
+            index = array('i', [-1]) * (max(series.ordinals) - base + 1)
+            for position, ordinal in enumerate(series.ordinals):
+                index[ordinal - base] = position
+            series._index = index
+            series._index_base = base
+
+        return series
+
+    @classmethod
+    def from_raw(cls, raw_data, source=None):
+        """Inversa de to_raw; 'source' fija el origen si no se guardó."""
+        series = cls()
+
+        for fecha, data in raw_data.items():
+            series.upsert(
+                date.fromisoformat(fecha).toordinal(),
+                to_scaled(Decimal(data['temp'])),
+                to_scaled(Decimal(data['sd'])),
+                month_id_of(data['adjusted_month']),
+                data.get('source', source),
+                data['adjusted_month'] != fecha[:7]
+            )
+
+        return series
+
+
+# ============================================================================
+# ESTADO PERSISTIDO (INSTANTÁNEA DE LA SERIE DIARIA)
+# ============================================================================
+
+def read_state_bytes(bucket, key):
+    """Lee un objeto de estado del bucket. Devuelve None si no existe."""
+    metrics = get_metrics()
+    metrics.count('s3_get_calls')
+    with metrics.io('s3'):
+        body = get_object_source().read_object(bucket, key)
+    if body is None:
+        return None
+
+    metrics.count('bytes_read', len(body))
+    return body
+
+
+def write_state_bytes(bucket, key, body, content_type):
+    """Guarda un objeto de estado en el bucket."""
+    metrics = get_metrics()
+    metrics.count('s3_put_calls')
+    with metrics.io('s3'):
+        get_object_source().write_object(bucket, key, body, content_type=content_type)
+
+
+def load_state_object(bucket, key):
+    """Lee un objeto de estado JSON del bucket. Devuelve None si no existe."""
+    body = read_state_bytes(bucket, key)
+    return json.loads(body) if body is not None else None
+
+
+def save_state_object(bucket, key, document):
+    """Guarda un objeto de estado JSON en el bucket."""
+    body = json.dumps(document, separators=(',', ':')).encode('utf-8')
+    write_state_bytes(bucket, key, body, 'application/json')
+
+
+def encode_snapshot(series, covered, tails=None):
+    """
+    Serializa la serie diaria fusionada y los objetos que incluye.
+
+    Formato: SNAPSHOT_MAGIC | longitud de la cabecera (uint32 LE) | cabecera
+    JSON | columnas de la serie en binario, una tras otra, en el orden de
+    DailySeries.COLUMNS. La cabecera guarda el número de filas, el orden de
+    bytes, el tipo y tamaño de cada columna, la tabla de orígenes, el
+    manifiesto {clave: ETag} de los objetos ya aplicados y la frontera de
+    los que se pueden ampliar leyendo solo su final ({clave: frontera}).
+    """
+    # Solo se guardan los orígenes que todavía ganan alguna fecha
+    used_ids = sorted(set(series.source_ids))
+    new_ids = {source_id: new_id for new_id, source_id in enumerate(used_ids)}
+
+    columns = series.columns()
+    columns['source_ids'] = array('I', (new_ids[source_id] for source_id in series.source_ids))
+
+    header = {
+        'rows': len(series),
+        'byteorder': sys.byteorder,
+        'columns': [[name, columns[name].typecode, columns[name].itemsize] for name in DailySeries.COLUMNS],
+        'sources': [series.sources[source_id] for source_id in used_ids],
+        'covered': covered,
+        'tails': tails or {}
+    }
+    header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+
+    return b''.join([
+        SNAPSHOT_MAGIC,
+        struct.pack('<I', len(header_bytes)),
+        header_bytes,
+        *(columns[name].tobytes() for name in DailySeries.COLUMNS)
+    ])
+
+
+def decode_snapshot(data):
+    """
+    Inversa de encode_snapshot.
+
+    Returns:
+        tuple: (DailySeries, {clave: ETag}, {clave: frontera})
+
+    Raises:
+        ValueError: si el objeto no es una instantánea válida para esta plataforma
+    """
+    if not data.startswith(SNAPSHOT_MAGIC):
+        raise ValueError("unknown snapshot format")
+
+    view = memoryview(data)
+    offset = len(SNAPSHOT_MAGIC)
+    (header_size,) = struct.unpack_from('<I', data, offset)
+    offset += 4
+    header = json.loads(bytes(view[offset:offset + header_size]))
+    offset += header_size
+
+    columns = {}
+    for name, typecode, itemsize in header['columns']:
+        column = array(typecode)
+        if column.itemsize != itemsize:
+            raise ValueError(f"column {name} has itemsize {itemsize}, expected {column.itemsize}")
+
+        size = itemsize * header['rows']
+        if offset + size > len(data):
+            raise ValueError("truncated snapshot")
+
+        column.frombytes(view[offset:offset + size])
+        if header['byteorder'] != sys.byteorder:
+            column.byteswap()
+        columns[name] = column
+        offset += size
+
+    return DailySeries.from_columns(columns, header['sources']), header['covered'], header.get('tails', {})
+
+
+def load_snapshot(bucket):
+    """
+    Carga la instantánea de la serie diaria (un solo GET).
+
+    Returns:
+        tuple: (DailySeries, {clave: ETag} de los objetos incluidos, {clave: frontera})
+        None: si no existe o no se puede leer (se reconstruirá)
+    """
+    data = read_state_bytes(bucket, SNAPSHOT_KEY)
+    if data is None:
+        return None
+
+    try:
+        return decode_snapshot(data)
+    except (ValueError, KeyError, struct.error) as e:
+        print(f"Warning: discarding unreadable snapshot {SNAPSHOT_KEY}: {e}")
+        return None
+
+
+def save_snapshot(bucket, series, covered, tails=None):
+    """Guarda la instantánea de la serie diaria (un solo PUT)."""
+    write_state_bytes(bucket, SNAPSHOT_KEY, encode_snapshot(series, covered, tails), 'application/octet-stream')
+
+
+def covered_tails(covered, boundaries, previous_covered, previous_tails):
+    """
+    Fronteras a guardar con la instantánea: la de los objetos leídos en esta
+    invocación y, para los demás, la anterior si su ETag no ha cambiado.
+    """
+    tails = {}
+    if not TAIL_READS_ENABLED:
+        return tails
+
+    for key, etag in covered.items():
+        if key in boundaries:
+            boundary = boundaries[key]
+        elif previous_covered.get(key) == etag:
+            boundary = previous_tails.get(key)
+        else:
+            boundary = None
+
+        if boundary is not None:
+            tails[key] = boundary
+
+    return tails
+
+
+# ============================================================================
+# MANIFIESTO DE OBJETOS (CLAVE -> ETAG -> DATOS PARSEADOS)
+# ============================================================================
+
+def load_manifest(bucket):
+    """
+    Carga el manifiesto de objetos ya parseados.
+
+    Returns:
+        dict: {'temperatura_1.csv': {'etag': '"abc..."', 'data': DailySeries}}
+    """
+    raw_manifest = load_state_object(bucket, MANIFEST_KEY) or {}
+
+    return {
+        key: {
+            'etag': entry['etag'],
+            'data': DailySeries.from_raw(entry['data'], source=key)
+        }
+        for key, entry in raw_manifest.items()
+    }
+
+
+def save_manifest(bucket, manifest):
+    """
+    Guarda el manifiesto. El origen de cada fila solo se guarda si no es la
+    propia clave (archivos compactados).
+    """
+    raw_manifest = {
+        key: {
+            'etag': entry['etag'],
+            'data': entry['data'].to_raw(include_source=entry['data'].sources != [key])
+        }
+        for key, entry in sorted(manifest.items())
+    }
+
+    save_state_object(bucket, MANIFEST_KEY, raw_manifest)
+
+
+# ============================================================================
+# REGISTRO DE ALERTAS (DEDUPLICACIÓN Y RESUMEN)
+# ============================================================================
+
+def alert_ledger_key(fecha, threshold=None):
+    """Clave del registro de alertas: una alarma por fecha y umbral."""
+    if threshold is None:
+        threshold = DEVIATION_THRESHOLD
+    return f"{fecha}|{threshold}"
+
+
+def collect_alerts(pending_alerts, series):
+    """Anota como alarmas candidatas las filas cuya desviación supera el umbral."""
+    # Comparación exacta entero escalado vs Decimal escalado
+    threshold_scaled = DEVIATION_THRESHOLD.scaleb(4)
+
+    for position, sd in enumerate(series.sds):
+        if sd > threshold_scaled:
+            fecha = series.fecha(position)
+            pending_alerts[alert_ledger_key(fecha)] = {
+                'fecha': fecha,
+                'sd': from_scaled(sd),
+                'temp': from_scaled(series.temps[position]),
+                'source': series.source(position)
+            }
+
+
+def alert_item_key(ledger_key):
+    """Clave en la tabla de control del item de una alarma ('fecha|umbral')."""
+    return f"{ALERT_ITEM_PREFIX}{ledger_key}"
+
+
+def read_alert_items(keys, projection=None):
+    """Lee items del registro de alarmas contando las peticiones."""
+    metrics = get_metrics()
+    with metrics.io('dynamodb'):
+        items, read_summary = get_control_sink().get_items(keys, projection)
+    metrics.count('dynamodb_read_requests', read_summary['read_requests'])
+    metrics.count('consumed_read_capacity', read_summary['consumed_read_capacity'])
+    return items
+
+
+def alert_ledger_call(operation, *args):
+    """Escritura condicional (una petición) sobre el registro de alarmas."""
+    metrics = get_metrics()
+    metrics.count('dynamodb_write_requests')
+    with metrics.io('dynamodb'):
+        return operation(*args)
+
+
+def register_alerts(pending_alerts, owner, claim_expires):
+    """
+    Crea el item de cada alarma que aún no está en el registro, pendiente y
+    ya reservado por 'owner' hasta 'claim_expires'. La creación es
+    condicional, así que si dos invocaciones recogen la misma alarma solo
+    una la crea (y la publica).
+
+    Returns:
+        tuple: (items creados por esta invocación, alarmas que ya estaban registradas)
+    """
+    sink = get_control_sink()
+    keys = {alert_item_key(ledger_key): alert for ledger_key, alert in pending_alerts.items()}
+    known = read_alert_items(list(keys), projection='monthYear')
+    new_keys = [key for key in sorted(keys) if key not in known]
+
+    if not new_keys:
+        return [], len(pending_alerts)
+
+    registered_at = datetime.now().isoformat()
+
+    def register(key):
+        item = {
+            'monthYear': key, **keys[key], 'registered_at': registered_at,
+            'alert_state': ALERT_PENDING, 'claim_owner': owner, 'claim_expires': claim_expires
+        }
+        return item if alert_ledger_call(sink.insert_item, item) else None
+
+    # Una escritura condicional por alarma nueva, en paralelo (en un arranque
+    # en frío pueden ser cientos)
+    with ThreadPoolExecutor(max_workers=min(FETCH_WORKERS, len(new_keys))) as executor:
+        created = [item for item in executor.map(register, new_keys) if item is not None]
+
+    return created, len(pending_alerts) - len(created)
+
+
+def claim_pending_alerts(owner, now, claim_expires):
+    """
+    Reserva para 'owner' las alarmas que siguen pendientes de invocaciones
+    anteriores (un mensaje que falló o una invocación que murió antes de
+    publicar) y que nadie tiene reservadas. Las busca en el índice
+    disperso ALERT_STATE_INDEX: sin pendientes es una sola lectura.
+
+    Returns:
+        list: Items reservados
+    """
+    metrics = get_metrics()
+    sink = get_control_sink()
+    with metrics.io('dynamodb'):
+        items, read_summary = sink.query_items(ALERT_STATE_INDEX, 'alert_state', ALERT_PENDING)
+    metrics.count('dynamodb_read_requests', read_summary['read_requests'])
+    metrics.count('consumed_read_capacity', read_summary['consumed_read_capacity'])
+
+    # El índice se actualiza con retraso: la reserva condicional decide
+    candidates = [item for item in items if item.get('claim_expires', 0) < now]
+    if not candidates:
+        return []
+
+    def claim(item):
+        return alert_ledger_call(sink.claim_item, item['monthYear'], owner, now, claim_expires)
+
+    with ThreadPoolExecutor(max_workers=min(FETCH_WORKERS, len(candidates))) as executor:
+        return [item for item, claimed in zip(candidates, executor.map(claim, candidates)) if claimed]
+
+
+def dispatch_alerts(pending_alerts):
+    """
+    Envía solo las alarmas que no figuran en el registro de la tabla de
+    control.
+
+    Cada alarma nueva se registra una sola vez (ver register_alerts), ya
+    reservada por esta invocación; además, en cada invocación se reservan
+    las que siguen pendientes de las anteriores (ver claim_pending_alerts),
+    aunque no traiga archivos nuevos. Todas se publican en mensajes resumen
+    de hasta ALERT_DIGEST_SIZE alarmas. Las publicadas se reescriben con
+    sent_at (por lotes: nadie más puede tocarlas mientras dura la reserva,
+    ALERT_CLAIM_SECONDS) y las de los mensajes que fallan se liberan para
+    el siguiente intento. Si la invocación muere antes, su reserva caduca y
+    otra invocación las publica. Como cada alarma tiene su propio estado, un
+    fallo entre dos escrituras no deja ninguna sin enviar.
+
+    El registro crece en un item por fecha y umbral con alarma, y cada
+    invocación solo lee los items de sus alarmas candidatas y las pendientes.
+
+    Args:
+        pending_alerts: {clave_registro: alarma} recogidas con collect_alerts
+
+    Returns:
+        dict: {'alerts_sent', 'alerts_suppressed', 'alert_messages'}
+    """
+    summary = {'alerts_sent': 0, 'alerts_suppressed': 0, 'alert_messages': 0}
+
+    if not ALERT_LEDGER_ENABLED:
+        alerts = [alert for _, alert in sorted(pending_alerts.items())]
+        send_alert_digests(alerts, summary)
+        return summary
+
+    owner = uuid.uuid4().hex
+    now = time.time()
+    claim_expires = int(now) + ALERT_CLAIM_SECONDS
+
+    created = []
+    if pending_alerts:
+        created, summary['alerts_suppressed'] = register_alerts(pending_alerts, owner, claim_expires)
+
+    alerts = sorted(created + claim_pending_alerts(owner, now, claim_expires), key=lambda item: item['monthYear'])
+    if not alerts:
+        return summary
+
+    failed = {alert['monthYear'] for alert in send_alert_digests(alerts, summary)}
+    sink = get_control_sink()
+
+    sent_at = datetime.now().isoformat()
+    sent = [
+        {**{name: value for name, value in alert.items() if name not in ('alert_state', 'claim_owner', 'claim_expires')},
+         'sent_at': sent_at}
+        for alert in alerts if alert['monthYear'] not in failed
+    ]
+    if sent:
+        metrics = get_metrics()
+        with metrics.io('dynamodb'):
+            write_summary = sink.put_items(sent)
+        metrics.count('dynamodb_write_requests', write_summary['write_requests'])
+        metrics.count('consumed_write_capacity', write_summary['consumed_write_capacity'])
+
+    for key in sorted(failed):
+        alert_ledger_call(sink.release_claim, key, owner)
+
+    return summary
+
+
+def send_alert_digests(alerts, summary):
+    """
+    Publica las alarmas en mensajes de hasta ALERT_DIGEST_SIZE y actualiza
+    'summary'.
+
+    Returns:
+        list: Alarmas de los mensajes que no se han podido publicar
+    """
+    failed = []
+
+    for i in range(0, len(alerts), ALERT_DIGEST_SIZE):
+        digest = alerts[i:i + ALERT_DIGEST_SIZE]
+
+        if send_alert_digest(digest):
+            summary['alert_messages'] += 1
+            summary['alerts_sent'] += len(digest)
+        else:
+            failed.extend(digest)
+
+    return failed
+
+
+# ============================================================================
+# FUSIÓN Y AGREGACIÓN MENSUAL
+# ============================================================================
+
+def merge_file_data(merged_daily_data, file_data):
+    """
+    Fusiona la serie de un archivo sobre la serie acumulada (última gana,
+    ver DailySeries.upsert).
+
+    Returns:
+        set: Meses ajustados ('YYYY-MM') cuyos valores (temp/sd) han cambiado
+    """
+    return {month_of_id(month_id) for month_id in merged_daily_data.merge(file_data)}
+
+
+def dirty_months(changed_months):
+    """
+    Meses a recalcular cuando cambian 'changed_months': ellos mismos y su mes
+    siguiente, cuyo max_diff_temp depende del max_temp del mes anterior.
+    """
+    return set(changed_months) | {next_month_of(mes) for mes in changed_months}
+
+
+# ============================================================================
+# MOTOR DE AGREGACIÓN MENSUAL
+# ============================================================================
+
+def aggregate_monthly_metrics(merged_daily_data, months=None):
+    """
+    Calcula en una sola pasada agrupada las métricas de los meses ajustados.
+
+    Trabaja directamente sobre las columnas de la DailySeries: con NumPy se
+    ven sin copia y se usan reducciones por grupo; si no, un bucle
+    equivalente en Python. Los resultados son enteros escalados y se
+    convierten a Decimal solo al escribir (ver update_monthly_aggregates).
+
+    Args:
+        merged_daily_data: DailySeries fusionada
+        months: Meses ('YYYY-MM') a calcular (default: todos). Solo se
+                agrupan sus filas y las de su mes anterior; los que no
+                tienen datos no aparecen en el resultado.
+
+    Returns:
+        dict: {'2023-01': {'max_temp', 'max_sd', 'sum_temp', 'count', 'prev_max_temp'}}
+              prev_max_temp es None si el mes anterior no está en los datos
+    """
+    month_ids = None
+    if months is not None:
+        month_ids = {month_id_of(mes) for mes in months}
+        if not month_ids:
+            return {}
+
+    if not len(merged_daily_data):
+        return {}
+
+    np = get_numpy()
+    if np is not None:
+        return _aggregate_numpy(merged_daily_data, np, month_ids)
+
+    return _aggregate_python(merged_daily_data, month_ids)
+
+
+def _aggregate_numpy(series, np, wanted=None):
+    month_ids = np.frombuffer(series.month_ids, dtype=np.int32).astype(np.int64)
+    temps = np.frombuffer(series.temps, dtype=np.int64)
+    sds = np.frombuffer(series.sds, dtype=np.int64)
+
+    if wanted is not None:
+        # Filas de los meses pedidos y de su mes anterior (prev_max_temp)
+        needed = np.fromiter(wanted | {month_id - 1 for month_id in wanted}, dtype=np.int64)
+        mask = np.isin(month_ids, needed)
+        month_ids, temps, sds = month_ids[mask], temps[mask], sds[mask]
+        if not len(month_ids):
+            return {}
+
+    order = np.argsort(month_ids, kind='stable')
+    month_ids, temps, sds = month_ids[order], temps[order], sds[order]
+
+    unique_months, starts = np.unique(month_ids, return_index=True)
+    counts = np.diff(np.append(starts, len(month_ids)))
+    max_temps = np.maximum.reduceat(temps, starts)
+    max_sds = np.maximum.reduceat(sds, starts)
+    sum_temps = np.add.reduceat(temps, starts)
+
+    # Máximo del mes anterior (si está en los datos)
+    prev_pos = np.searchsorted(unique_months, unique_months - 1)
+    prev_pos_clipped = np.minimum(prev_pos, len(unique_months) - 1)
+    has_prev = unique_months[prev_pos_clipped] == unique_months - 1
+
+    metrics = {}
+    for i, month_id in enumerate(unique_months.tolist()):
+        if wanted is not None and month_id not in wanted:
+            continue
+        metrics[month_of_id(month_id)] = {
+            'max_temp': int(max_temps[i]),
+            'max_sd': int(max_sds[i]),
+            'sum_temp': int(sum_temps[i]),
+            'count': int(counts[i]),
+            'prev_max_temp': int(max_temps[prev_pos_clipped[i]]) if has_prev[i] else None
+        }
+
+    return metrics
+
+
+def _aggregate_python(series, wanted=None):
+    groups = {}
+    needed = None if wanted is None else wanted | {month_id - 1 for month_id in wanted}
+
+    for month_id, temp, sd in zip(series.month_ids, series.temps, series.sds):
+        if needed is not None and month_id not in needed:
+            continue
+        group = groups.get(month_id)
+        if group is None:
+            groups[month_id] = [temp, sd, temp, 1]
+        else:
+            if temp > group[0]:
+                group[0] = temp
+            if sd > group[1]:
+                group[1] = sd
+            group[2] += temp
+            group[3] += 1
+
+    metrics = {}
+    for month_id in sorted(groups):
+        if wanted is not None and month_id not in wanted:
+            continue
+        max_temp, max_sd, sum_temp, count = groups[month_id]
+        previous = groups.get(month_id - 1)
+        metrics[month_of_id(month_id)] = {
+            'max_temp': max_temp,
+            'max_sd': max_sd,
+            'sum_temp': sum_temp,
+            'count': count,
+            'prev_max_temp': previous[0] if previous is not None else None
+        }
+
+    return metrics
+
+
+def batch_write_items(items, concurrency=None, table_name=None):
+    """
+    Escribe items en DynamoDB con BatchWriteItem (hasta 25 por petición).
+
+    Los UnprocessedItems se reintentan con backoff exponencial; si tras
+    BATCH_MAX_RETRIES reintentos quedan items sin escribir se lanza
+    una excepción. Con concurrency > 1 se envían varios lotes en paralelo.
+
+    Args:
+        items: Lista de items (tipos Python, Decimal para números)
+        concurrency: Lotes simultáneos (default: WRITE_CONCURRENCY)
+        table_name: Tabla destino (default: DYNAMODB_TABLE)
+
+    Returns:
+        dict: {'items_written', 'write_batches', 'write_requests', 'write_retries', 'consumed_write_capacity'}
+    """
+    if concurrency is None:
+        concurrency = WRITE_CONCURRENCY
+
+    client = get_dynamodb_client()
+    table_name = table_name or get_table_name()
+    serializer, _ = get_dynamodb_types()
+    batches = [items[i:i + BATCH_WRITE_SIZE] for i in range(0, len(items), BATCH_WRITE_SIZE)]
+
+    def write_batch(batch):
+        summary = {'write_requests': 0, 'write_retries': 0, 'consumed_write_capacity': 0.0}
+        pending = [
+            {'PutRequest': {'Item': {name: serializer.serialize(value) for name, value in item.items()}}}
+            for item in batch
+        ]
+
+        for attempt in range(BATCH_MAX_RETRIES + 1):
+            if attempt:
+                summary['write_retries'] += 1
+                time.sleep(min(BATCH_RETRY_BASE_DELAY * (2 ** (attempt - 1)), 2.0))
+
+            response = client.batch_write_item(
+                RequestItems={table_name: pending},
+                ReturnConsumedCapacity='TOTAL'
+            )
+            summary['write_requests'] += 1
+
+            for consumed in response.get('ConsumedCapacity', []):
+                summary['consumed_write_capacity'] += consumed.get('CapacityUnits', 0)
+
+            pending = response.get('UnprocessedItems', {}).get(table_name, [])
+            if not pending:
+                return summary
+
+        months = [request['PutRequest']['Item']['monthYear']['S'] for request in pending]
+        raise Exception(f"Unprocessed items after {BATCH_MAX_RETRIES} retries: {months}")
+
+    if concurrency > 1 and len(batches) > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            summaries = list(executor.map(write_batch, batches))
+    else:
+        summaries = [write_batch(batch) for batch in batches]
+
+    return {
+        'items_written': len(items),
+        'write_batches': len(batches),
+        'write_requests': sum(summary['write_requests'] for summary in summaries),
+        'write_retries': sum(summary['write_retries'] for summary in summaries),
+        'consumed_write_capacity': sum(summary['consumed_write_capacity'] for summary in summaries)
+    }
+
+
+def batch_get_items(month_keys, projection=None, concurrency=None, table_name=None):
+    """
+    Lee items de DynamoDB con BatchGetItem (hasta 100 claves por petición).
+
+    Los UnprocessedKeys se reintentan con backoff exponencial y, con
+    concurrency > 1, los trozos se piden en paralelo.
+
+    Args:
+        month_keys: Iterable de valores de monthYear
+        projection: ProjectionExpression opcional
+        concurrency: Peticiones simultáneas (default: READ_CONCURRENCY)
+        table_name: Tabla a leer (default: DYNAMODB_TABLE)
+
+    Returns:
+        tuple: ({monthYear: item}, {'read_requests', 'read_retries', 'consumed_read_capacity'})
+    """
+    if concurrency is None:
+        concurrency = READ_CONCURRENCY
+
+    client = get_dynamodb_client()
+    table_name = table_name or get_table_name()
+    _, deserializer = get_dynamodb_types()
+    month_keys = sorted(set(month_keys))
+    chunks = [month_keys[i:i + BATCH_GET_SIZE] for i in range(0, len(month_keys), BATCH_GET_SIZE)]
+
+    def read_chunk(chunk):
+        items = {}
+        summary = {'read_requests': 0, 'read_retries': 0, 'consumed_read_capacity': 0.0}
+        request = {'Keys': [{'monthYear': {'S': mes}} for mes in chunk]}
+        if projection:
+            request['ProjectionExpression'] = projection
+
+        for attempt in range(BATCH_MAX_RETRIES + 1):
+            if attempt:
+                summary['read_retries'] += 1
+                time.sleep(min(BATCH_RETRY_BASE_DELAY * (2 ** (attempt - 1)), 2.0))
+
+            response = client.batch_get_item(
+                RequestItems={table_name: request},
+                ReturnConsumedCapacity='TOTAL'
+            )
+            summary['read_requests'] += 1
+
+            for consumed in response.get('ConsumedCapacity', []):
+                summary['consumed_read_capacity'] += consumed.get('CapacityUnits', 0)
+
+            for raw_item in response.get('Responses', {}).get(table_name, []):
+                item = {name: deserializer.deserialize(value) for name, value in raw_item.items()}
+                items[item['monthYear']] = item
+
+            unprocessed = response.get('UnprocessedKeys', {}).get(table_name)
+            if not unprocessed:
+                return items, summary
+
+            request = unprocessed
+
+        raise Exception(f"Unprocessed keys after {BATCH_MAX_RETRIES} retries: {request['Keys']}")
+
+    if concurrency > 1 and len(chunks) > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(read_chunk, chunks))
+    else:
+        results = [read_chunk(chunk) for chunk in chunks]
+
+    items = {}
+    summary = {'read_requests': 0, 'read_retries': 0, 'consumed_read_capacity': 0.0}
+    for chunk_items, chunk_summary in results:
+        items.update(chunk_items)
+        for name, value in chunk_summary.items():
+            summary[name] += value
+
+    return items, summary
+
+
+def prefetch_month_items(monthly_metrics, months, emptied=()):
+    """
+    Obtiene del destino de agregados (DynamoDB: un solo lote de BatchGetItem):
+      - el max_temp de los meses anteriores que no están en los datos procesados
+        (0 si el mes se ha quedado sin datos: su item se va a borrar)
+      - el content_hash guardado de los meses a escribir (para omitir los que no cambian)
+      - qué meses de 'emptied' (sin datos) tienen item guardado
+
+    Returns:
+        tuple: ({mes_anterior: Decimal max_temp}, {mes: content_hash},
+                set de meses de 'emptied' guardados, resumen de lectura)
+    """
+    missing_months = {
+        previous_month_of(mes) for mes in months
+        if monthly_metrics[mes]['prev_max_temp'] is None
+    }
+
+    keys_to_read = missing_months | set(emptied)
+    if SKIP_UNCHANGED_MONTHS:
+        keys_to_read.update(months)
+
+    metrics = get_metrics()
+    with metrics.io('dynamodb'):
+        stored_items, read_summary = get_aggregate_sink().get_items(
+            keys_to_read, projection='monthYear, max_temp, content_hash'
+        )
+    metrics.count('dynamodb_read_requests', read_summary['read_requests'])
+    metrics.count('consumed_read_capacity', read_summary['consumed_read_capacity'])
+
+    previous_max = {
+        mes: Decimal(0) if mes in emptied else Decimal(str(stored_items.get(mes, {}).get('max_temp', 0)))
+        for mes in missing_months
+    }
+    stored_hashes = {
+        mes: item['content_hash']
+        for mes, item in stored_items.items()
+        if 'content_hash' in item
+    }
+    stored_emptied = {mes for mes in emptied if mes in stored_items}
+    read_summary['prefetched_months'] = len(missing_months)
+
+    return previous_max, stored_hashes, stored_emptied, read_summary
+
+
+def month_content_hash(item):
+    """Hash de las métricas de un mes (sin last_updated) para detectar cambios."""
+    canonical = "|".join(str(item[name]) for name in MONTH_METRIC_FIELDS)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def update_monthly_aggregates(monthly_metrics, months=None):
+    """
+    Convierte las métricas mensuales a Decimal y las guarda en el destino de
+    agregados (DynamoDB por lotes).
+
+    Cada item lleva un content_hash de sus métricas; si coincide con el ya
+    guardado el mes no se reescribe (ni cambia su last_updated).
+
+    Args:
+        monthly_metrics: Resultado de aggregate_monthly_metrics
+        months: Meses a actualizar (default: todos los de monthly_metrics). Los
+                que no están en monthly_metrics se han quedado sin datos y su
+                item se borra.
+
+    Returns:
+        dict: Resumen de lectura y escritura (ver batch_get_items y batch_write_items)
+              más 'months_skipped' y 'months_deleted'
+    """
+    if months is None:
+        months = monthly_metrics.keys()
+    emptied = {mes for mes in months if mes not in monthly_metrics}
+    months = [mes for mes in months if mes in monthly_metrics]
+
+    # Meses anteriores fuera de los datos, hashes guardados y meses sin datos: todo de una vez
+    previous_max, stored_hashes, stored_emptied, read_summary = prefetch_month_items(monthly_metrics, months, emptied)
+
+    items = []
+    months_skipped = 0
+    last_updated = datetime.now().isoformat()
+
+    for mes in sorted(months):
+        metrics = monthly_metrics[mes]
+
+        max_temp = from_scaled(metrics['max_temp'])
+        max_sd = from_scaled(metrics['max_sd'])
+        mean_temp = round_decimal(from_scaled(metrics['sum_temp']) / metrics['count'])
+        count = metrics['count']
+
+        # Buscar mes anterior en datos procesados o DB
+        if metrics['prev_max_temp'] is not None:
+            prev_max = from_scaled(metrics['prev_max_temp'])
+        else:
+            # Valor precargado de DynamoDB (0 si no existe)
+            prev_max = previous_max[previous_month_of(mes)]
+
+        max_diff_temp = round_decimal(max_temp - prev_max)
+
+        item = {
+            'monthYear': mes,
+            'max_temp': max_temp,
+            'max_sd': max_sd,
+            'mean_temp': mean_temp,
+            'max_diff_temp': max_diff_temp,
+            'mean_temp_count': count
+        }
+        item['content_hash'] = month_content_hash(item)
+
+        if SKIP_UNCHANGED_MONTHS and stored_hashes.get(mes) == item['content_hash']:
+            months_skipped += 1
+            continue
+
+        item['last_updated'] = last_updated
+        items.append(item)
+
+    try:
+        metrics = get_metrics()
+        with metrics.io('dynamodb'):
+            write_summary = get_aggregate_sink().put_items(items)
+            get_aggregate_sink().delete_items(sorted(stored_emptied))
+        metrics.count('dynamodb_write_requests', write_summary['write_requests'] + len(stored_emptied))
+        metrics.count('consumed_write_capacity', write_summary['consumed_write_capacity'])
+
+        return {**read_summary, **write_summary, 'months_skipped': months_skipped,
+                'months_deleted': len(stored_emptied)}
+
+    except Exception as e:
+        print(f"Error updating months {[item['monthYear'] for item in items]}: {e}")
+        raise
+
+
+# ============================================================================
+# MODOS DE INGESTA
+# ============================================================================
+
+def run_full_ingestion(bucket, trigger_keys):
+    """
+    Procesa TODOS los archivos CSV del bucket y actualiza los meses afectados.
+
+    Una sola pasada cubre todas las claves del evento ('trigger_keys'), ya
+    que el listado las incluye. Con SNAPSHOT_ENABLED se parte de la
+    instantánea de la serie diaria y solo se leen los CSV que todavía no
+    incluye (ver ingest_all_objects).
+
+    Returns:
+        dict: Estadísticas de la invocación, o None si el bucket no tiene CSV
+    """
+    snapshot = None
+    if SNAPSHOT_ENABLED:
+        with get_metrics().stage('load_state'):
+            snapshot = load_snapshot(bucket)
+
+    return ingest_all_objects(bucket, snapshot, persist_snapshot=SNAPSHOT_ENABLED)
+
+
+def ingest_all_objects(bucket, snapshot, persist_snapshot):
+    """
+    Fusiona todos los CSV del bucket y actualiza los meses afectados.
+
+    Si hay instantánea y ninguno de los objetos que incluye ha cambiado de
+    ETag ni se ha borrado, solo se leen y fusionan los objetos nuevos (la
+    regla "última gana" no depende del orden de fusión). Los que han cambiado
+    solo añadiendo filas al final se amplían leyendo únicamente esas filas
+    (ver read_csv_tail). Si no, la serie se reconstruye desde todos los CSV
+    (con el manifiesto por ETag si está activo).
+
+    Un CSV que se vuelve a subir después de compactarlo (su copia sigue en
+    ARCHIVE_PREFIX) sustituye a sus filas de los compactados: la instantánea
+    se reconstruye y esas filas se descartan al fusionar los compactados.
+
+    Solo se recalculan y escriben los meses ajustados cuyas fechas cambian
+    respecto a la instantánea (al fusionar los objetos nuevos o al
+    compararla con la serie reconstruida) y su mes siguiente. Sin
+    instantánea no se sabe qué hay en la tabla y se recalculan todos.
+
+    Args:
+        bucket: Nombre del bucket
+        snapshot: (DailySeries, {clave: ETag}, {clave: frontera}) cargada con load_snapshot, o None
+        persist_snapshot: Guardar la instantánea resultante
+
+    Returns:
+        dict: Estadísticas de la invocación, o None si el bucket no tiene CSV
+    """
+    metrics = get_metrics()
+
+    # ============================================================
+    # PASO 1: Listar TODOS los archivos CSV del bucket (paginado)
+    # ============================================================
+    listing_stats = {}
+    archived = set()  # Claves originales de los CSV archivados por la compactación
+    all_csv_files = iter_csv_objects(bucket, INPUT_PREFIX, listing_stats, archived)
+
+    merged_daily_data = DailySeries()
+    covered = {}  # {clave: ETag} de los objetos incluidos en la serie
+    boundaries = {}  # {clave: frontera} de los objetos leídos en esta pasada
+    appended = {}  # {clave: (DailySeries, ETag, frontera)} de los ampliados por el final
+    previous_covered, previous_tails = ({}, {}) if snapshot is None else (dict(snapshot[1]), snapshot[2])
+    snapshot_status = "created" if persist_snapshot else "disabled"
+
+    if snapshot is not None:
+        # Para validar la instantánea hace falta el listado completo
+        with metrics.stage('list'):
+            listed = list(all_csv_files)
+        all_csv_files = listed
+
+        listed_etags = {obj['Key']: obj.get('ETag') for obj in listed}
+        changed = sorted(key for key, etag in previous_covered.items() if listed_etags.get(key) != etag)
+
+        # Objetos incluidos que solo han crecido por el final
+        if TAIL_READS_ENABLED:
+            with metrics.stage('fetch_parse'):
+                appended = read_csv_tails(
+                    bucket, [key for key in changed if key in listed_etags and key in previous_tails], previous_tails
+                )
+        stale = [key for key in changed if key not in appended or appended[key][1] != listed_etags[key]]
+        stale += [key for key in listed_etags if key in archived and key not in previous_covered]
+
+        if stale:
+            print(f"Snapshot invalidated by {len(stale)} modified, deleted or re-uploaded objects "
+                  f"({stale[0]}, ...); rebuilding")
+            snapshot_status = "rebuilt"
+            appended = {}
+        else:
+            merged_daily_data, covered, _ = snapshot
+            all_csv_files = [obj for obj in listed if obj['Key'] not in covered]
+            snapshot_status = "applied"
+
+    # Manifiesto: los objetos con el mismo ETag no se vuelven a leer (solo
+    # hace falta al reconstruir la serie completa)
+    use_manifest = MANIFEST_ENABLED and snapshot_status != "applied"
+    with metrics.stage('load_state'):
+        manifest = load_manifest(bucket) if use_manifest else {}
+    new_manifest = {}
+    manifest_hits = 0
+    manifest_misses = 0
+
+    # ============================================================
+    # PASO 2: Procesar todos los archivos y fusionar datos
+    # ============================================================
+    pending_alerts = {}  # {'2023-01-15|0.5': {...}}
+    total_rows = 0
+    files_processed = 0
+    month_adjustments = 0  # Contador de fechas ajustadas
+    changed_months = set()
+    files_merged = {}  # {clave: filas} de los archivos fusionados en esta pasada
+    unique_dates_before = len(merged_daily_data)
+
+    def merge_object(csv_key, file_data):
+        nonlocal files_processed, total_rows, month_adjustments, changed_months
+
+        files_processed += 1
+        total_rows += len(file_data)
+        files_merged[csv_key] = len(file_data)
+
+        # Fechas cuyo mes se ajustó (marcado al parsear)
+        month_adjustments += file_data.month_adjustments()
+
+        with metrics.stage('merge'):
+            # Detectar alertas (se envían al final, deduplicadas)
+            collect_alerts(pending_alerts, file_data)
+
+            # Fusionar: última aparición sobrescribe
+            changed_months |= merge_file_data(merged_daily_data, file_data)
+
+    # Filas añadidas al final de objetos ya incluidos (no van al manifiesto)
+    tail_rows = 0
+    for csv_key in sorted(appended):
+        file_data, etag, boundary = appended[csv_key]
+        covered[csv_key] = etag
+        boundaries[csv_key] = boundary
+
+        if file_data:
+            tail_rows += len(file_data)
+            merge_object(csv_key, file_data)
+
+    csv_files_found = 0
+    raw_keys = set()
+    compacted = []  # [(clave, DailySeries)] de los compactados, que se fusionan al final
+
+    # Las descargas empiezan mientras el listado sigue paginando y se
+    # fusionan en el orden original de las claves. 'fetch_parse' es el tiempo
+    # que el hilo principal espera al listado, las descargas y el parseo.
+    waiting_since = time.perf_counter()
+    fetched = fetch_csv_files(bucket, all_csv_files, manifest=manifest,
+                              boundaries=boundaries if TAIL_READS_ENABLED else None)
+    for csv_key, etag, file_data, from_manifest in fetched:
+        metrics.add_stage_time('fetch_parse', time.perf_counter() - waiting_since)
+        csv_files_found += 1
+
+        if from_manifest:
+            manifest_hits += 1
+        else:
+            manifest_misses += 1
+
+        # No se guardan en el manifiesto ni se dan por incluidos los
+        # archivos vacíos o con error (se vuelven a leer en el siguiente evento)
+        if file_data and etag is not None:
+            new_manifest[csv_key] = {'etag': etag, 'data': file_data}
+            covered[csv_key] = etag
+
+        if is_compacted_key(csv_key):
+            compacted.append((csv_key, file_data))
+        else:
+            raw_keys.add(csv_key)
+            if file_data:
+                merge_object(csv_key, file_data)
+
+        waiting_since = time.perf_counter()
+
+    metrics.add_stage_time('fetch_parse', time.perf_counter() - waiting_since)
+
+    # Los CSV que se han vuelto a subir después de compactarlos sustituyen a
+    # sus filas de los compactados (el listado ya está completo)
+    retired = archived & raw_keys
+    if retired and compacted:
+        print(f"Retiring compacted rows of {len(retired)} re-uploaded objects ({min(retired)}, ...)")
+        with metrics.stage('fetch_parse'):
+            refetched = fetch_csv_files(bucket, [key for key, _ in compacted], retired=retired)
+            compacted = []
+            for csv_key, etag, file_data, _ in refetched:
+                if etag is None:
+                    covered.pop(csv_key, None)
+                compacted.append((csv_key, file_data))
+
+    for csv_key, file_data in compacted:
+        if file_data:
+            merge_object(csv_key, file_data)
+
+    if not csv_files_found and not covered:
+        return None
+
+    if use_manifest and (manifest_misses or new_manifest.keys() != manifest.keys()):
+        with metrics.stage('save_state'):
+            save_manifest(bucket, new_manifest)
+
+    duplicates_found = total_rows - (len(merged_daily_data) - unique_dates_before)
+
+    # ============================================================
+    # PASO 3: Agrupar por mes AJUSTADO y calcular métricas
+    # ============================================================
+    with metrics.stage('aggregate'):
+        if snapshot_status == "applied":
+            months = dirty_months(changed_months)
+        elif snapshot_status == "rebuilt":
+            months = dirty_months({
+                month_of_id(month_id) for month_id in snapshot[0].changed_month_ids(merged_daily_data)
+            })
+        else:
+            months = None
+
+        monthly_metrics = aggregate_monthly_metrics(merged_daily_data, months)
+
+    # ============================================================
+    # PASO 4: Actualizar DynamoDB (y borrar los meses que se quedan sin datos)
+    # ============================================================
+    with metrics.stage('write'):
+        write_summary = update_monthly_aggregates(monthly_metrics, months)
+
+    # La instantánea se guarda después de escribir los meses: si la escritura
+    # falla, el siguiente evento vuelve a aplicar los mismos objetos
+    if persist_snapshot and (snapshot_status != "applied" or files_processed or appended):
+        with metrics.stage('save_state'):
+            save_snapshot(bucket, merged_daily_data, covered,
+                          covered_tails(covered, boundaries, previous_covered, previous_tails))
+
+    # ============================================================
+    # PASO 5: Enviar alarmas nuevas (registro + resumen)
+    # ============================================================
+    with metrics.stage('alert'):
+        alert_summary = dispatch_alerts(pending_alerts)
+
+    return {
+        "mode": "full",
+        "files_processed": files_processed,
+        "total_rows": total_rows,
+        "unique_dates": len(merged_daily_data),
+        "duplicates_overwritten": duplicates_found,
+        "month_adjustments": month_adjustments,
+        "months_recomputed": len(monthly_metrics),
+        "months_updated": write_summary['items_written'],
+        "months_skipped": write_summary['months_skipped'],
+        "months_deleted": write_summary['months_deleted'],
+        "alerts_sent": alert_summary['alerts_sent'],
+        "alerts_suppressed": alert_summary['alerts_suppressed'],
+        "alert_messages": alert_summary['alert_messages'],
+        "write_batches": write_summary['write_batches'],
+        "consumed_write_capacity": write_summary['consumed_write_capacity'],
+        "prefetched_months": write_summary['prefetched_months'],
+        "consumed_read_capacity": write_summary['consumed_read_capacity'],
+        "list_pages": listing_stats['list_pages'],
+        "listed_keys": listing_stats['listed_keys'],
+        "manifest_hits": manifest_hits,
+        "manifest_misses": manifest_misses,
+        "snapshot": snapshot_status,
+        "snapshot_objects": len(covered),
+        "tail_reads": len(appended),
+        "tail_rows": tail_rows,
+        "files_merged": files_merged,
+        "merged_daily_data": merged_daily_data
+    }
+
+
+def run_incremental_ingestion(bucket, trigger_keys):
+    """
+    Fusiona solo los archivos del evento ('trigger_keys') sobre la
+    instantánea de la serie diaria y recalcula los meses ajustados que
+    cambian (y su mes siguiente), con una sola agregación, escritura y
+    guardado de la instantánea para todo el lote.
+
+    Si no existe instantánea se inicializa con una pasada completa. De los
+    triggers ya incluidos se lee primero solo lo añadido al final (ver
+    read_csv_tail); si alguno ha cambiado de otra forma, la serie se
+    reconstruye (sus filas antiguas podrían no estar en la versión nueva).
+    También si un trigger no incluido es origen de filas de la serie: se ha
+    vuelto a subir después de compactarlo (ver ingest_all_objects).
+
+    Returns:
+        dict: Estadísticas de la invocación, o None si el bucket no tiene CSV
+    """
+    metrics = get_metrics()
+
+    with metrics.stage('load_state'):
+        snapshot = load_snapshot(bucket)
+
+    if snapshot is None:
+        stats = ingest_all_objects(bucket, None, persist_snapshot=True)
+        if stats is None:
+            return None
+
+        stats['mode'] = "incremental-bootstrap"
+        return stats
+
+    daily_state, covered, tails = snapshot
+    previous_covered = dict(covered)
+    boundaries = {}
+    appended = {}
+
+    if any(key not in covered and daily_state.has_source(key) for key in trigger_keys):
+        stats = ingest_all_objects(bucket, snapshot, persist_snapshot=True)
+        if stats is None:
+            return None
+
+        stats['mode'] = "incremental-rebuild"
+        return stats
+
+    with metrics.stage('fetch_parse'):
+        if TAIL_READS_ENABLED:
+            appended = read_csv_tails(bucket, [key for key in trigger_keys if key in covered and key in tails], tails)
+
+        remaining = [key for key in trigger_keys if key not in appended]
+        fetched = list(fetch_csv_files(bucket, remaining, max_workers=min(FETCH_WORKERS, len(remaining)),
+                                       boundaries=boundaries if TAIL_READS_ENABLED else None))
+
+    if any(key in covered and etag is not None and covered[key] != etag for key, etag, _, _ in fetched):
+        stats = ingest_all_objects(bucket, snapshot, persist_snapshot=True)
+        if stats is None:
+            return None
+
+        stats['mode'] = "incremental-rebuild"
+        return stats
+
+    pending_alerts = {}  # {'2023-01-15|0.5': {...}}
+    files_merged = {}
+    month_adjustments = 0
+    changed_months = set()
+    covered_changed = False
+    unique_dates_before = len(daily_state)
+
+    for key, (_, _, boundary) in appended.items():
+        boundaries[key] = boundary
+    objects = [(key, etag, file_data) for key, (file_data, etag, _) in sorted(appended.items())]
+    objects += [(key, etag, file_data) for key, etag, file_data, _ in fetched]
+
+    with metrics.stage('merge'):
+        for key, etag, file_data in objects:
+            if file_data:
+                files_merged[key] = len(file_data)
+                month_adjustments += file_data.month_adjustments()
+                collect_alerts(pending_alerts, file_data)
+                changed_months |= merge_file_data(daily_state, file_data)
+
+            # Los archivos vacíos o con error no se dan por incluidos (una
+            # ampliación sin filas nuevas sí, con su ETag nuevo)
+            if etag is not None and (file_data or key in appended) and covered.get(key) != etag:
+                covered[key] = etag
+                covered_changed = True
+
+    total_rows = sum(files_merged.values())
+    new_dates = len(daily_state) - unique_dates_before
+
+    with metrics.stage('aggregate'):
+        months = dirty_months(changed_months)
+        monthly_metrics = aggregate_monthly_metrics(daily_state, months)
+
+    with metrics.stage('write'):
+        write_summary = update_monthly_aggregates(monthly_metrics, months)
+
+    if changed_months or covered_changed:
+        with metrics.stage('save_state'):
+            save_snapshot(bucket, daily_state, covered, covered_tails(covered, boundaries, previous_covered, tails))
+
+    with metrics.stage('alert'):
+        alert_summary = dispatch_alerts(pending_alerts)
+
+    return {
+        "mode": "incremental",
+        "files_processed": len(files_merged),
+        "total_rows": total_rows,
+        "unique_dates": len(daily_state),
+        "duplicates_overwritten": total_rows - new_dates,
+        "month_adjustments": month_adjustments,
+        "months_recomputed": len(monthly_metrics),
+        "months_updated": write_summary['items_written'],
+        "months_skipped": write_summary['months_skipped'],
+        "months_deleted": write_summary['months_deleted'],
+        "alerts_sent": alert_summary['alerts_sent'],
+        "alerts_suppressed": alert_summary['alerts_suppressed'],
+        "alert_messages": alert_summary['alert_messages'],
+        "write_batches": write_summary['write_batches'],
+        "consumed_write_capacity": write_summary['consumed_write_capacity'],
+        "prefetched_months": write_summary['prefetched_months'],
+        "consumed_read_capacity": write_summary['consumed_read_capacity'],
+        "snapshot": "applied",
+        "snapshot_objects": len(covered),
+        "tail_reads": len(appended),
+        "tail_rows": sum(len(file_data) for file_data, _, _ in appended.values()),
+        "files_merged": files_merged,
+        "merged_daily_data": daily_state
+    }
+
+
+def run_ingestion_pass(bucket, trigger_keys):
+    """
+    Una pasada del modo de ingesta configurado para las claves de un bucket.
+
+    Returns:
+        tuple: (estadísticas o None si el bucket no tiene CSV,
+                {clave: filas} de los archivos fusionados en la pasada)
+    """
+    try:
+        if INGESTION_MODE == "incremental":
+            stats = run_incremental_ingestion(bucket, trigger_keys)
+        else:
+            stats = run_full_ingestion(bucket, trigger_keys)
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        raise Exception(f"Error processing bucket {bucket}: {str(e)}")
+
+    if stats is None:
+        return None, {}
+
+    stats.pop('merged_daily_data')
+    return stats, stats.pop('files_merged')
+
+
+# ============================================================================
+# IDEMPOTENCIA DE EVENTOS (MARCADORES CON TTL)
+# ============================================================================
+
+def event_marker_key(bucket, key, version):
+    """Clave del marcador de un registro (bucket, clave, sequencer/ETag)."""
+    return f"{EVENT_MARKER_PREFIX}{bucket}/{key}#{version}"
+
+
+def find_processed_events(marker_keys):
+    """
+    Marcadores ya guardados y sin caducar de 'marker_keys' (una lectura por
+    lotes). El TTL de DynamoDB borra los items con retraso, así que la
+    caducidad se comprueba también aquí.
+    """
+    if not marker_keys:
+        return set()
+
+    metrics = get_metrics()
+    with metrics.io('dynamodb'):
+        items, read_summary = get_control_sink().get_items(marker_keys, projection='monthYear, expires_at')
+    metrics.count('dynamodb_read_requests', read_summary['read_requests'])
+    metrics.count('consumed_read_capacity', read_summary['consumed_read_capacity'])
+
+    now = time.time()
+    return {marker for marker, item in items.items() if item.get('expires_at', 0) > now}
+
+
+def record_processed_events(marker_keys):
+    """Guarda los marcadores con caducidad IDEMPOTENCY_TTL_SECONDS."""
+    if not marker_keys:
+        return
+
+    expires_at = int(time.time()) + IDEMPOTENCY_TTL_SECONDS
+    metrics = get_metrics()
+    with metrics.io('dynamodb'):
+        write_summary = get_control_sink().put_items([
+            {'monthYear': marker, 'expires_at': expires_at} for marker in sorted(marker_keys)
+        ])
+    metrics.count('dynamodb_write_requests', write_summary['write_requests'])
+    metrics.count('consumed_write_capacity', write_summary['consumed_write_capacity'])
+
+
+# ============================================================================
+# COALESCENCIA DE RÁFAGAS (LEASE EN LA TABLA DE CONTROL)
+# ============================================================================
+
+def lease_call(operation, *args):
+    """Llama a una operación de lease del destino de control contando la petición."""
+    metrics = get_metrics()
+    metrics.count('lease_requests')
+    with metrics.io('dynamodb'):
+        return operation(*args)
+
+
+def run_coalesced_ingestion(pending, context):
+    """
+    Ingesta con coalescencia de ráfagas (COALESCE_ENABLED, y siempre en
+    modo incremental para que la instantánea no se guarde desde dos
+    invocaciones a la vez).
+
+    Cada invocación añade sus claves ('bucket/clave') al conjunto pendiente
+    del item LEASE_KEY e intenta tomar el lease (válido
+    COALESCE_WINDOW_SECONDS). Si otra invocación lo tiene, termina sin más:
+    el dueño procesará sus claves. El dueño saca las claves pendientes, hace
+    una pasada por bucket y repite hasta que no queda ninguna; solo libera
+    el lease si el conjunto sigue vacío, así que una clave añadida durante
+    la última pasada no se pierde. Una ráfaga de N subidas se queda en una o
+    dos pasadas.
+
+    Si una pasada falla, sus claves vuelven a pendientes y el lease se libera
+    para que el reintento del evento lo tome. Si no queda tiempo para otra
+    pasada (context.get_remaining_time_in_millis), el lease se libera y lo
+    pendiente se procesa en el siguiente evento.
+
+    Args:
+        pending: {bucket: [claves]} del evento
+        context: Contexto de la Lambda (o None fuera de ella)
+
+    Returns:
+        list: [(bucket, estadísticas, {clave: filas})] de las pasadas hechas;
+              vacía si otra invocación tiene el lease
+    """
+    sink = get_control_sink()
+    owner = getattr(context, 'aws_request_id', None) or uuid.uuid4().hex
+
+    lease_call(sink.add_pending, LEASE_KEY, [f"{bucket}/{key}" for bucket, keys in pending.items() for key in keys])
+
+    now = time.time()
+    if not lease_call(sink.acquire_lease, LEASE_KEY, owner, now, now + COALESCE_WINDOW_SECONDS):
+        return []
+
+    return drain_pending_keys(sink, owner, context)
+
+
+def drain_pending_keys(sink, owner, context):
+    """
+    Pasadas del dueño del lease sobre las claves pendientes, hasta que no
+    queda ninguna (ver run_coalesced_ingestion). Libera el lease al terminar.
+
+    Returns:
+        list: [(bucket, estadísticas, {clave: filas})] de las pasadas hechas
+    """
+    passes = []
+    longest_pass = 0.0
+
+    while True:
+        entries = lease_call(sink.take_pending, LEASE_KEY, owner)
+        if entries is None:
+            print(f"Lease {LEASE_KEY} taken over by another invocation; stopping")
+            break
+
+        if not entries:
+            if lease_call(sink.release_lease, LEASE_KEY, owner):
+                break
+            continue
+
+        # Los nombres de bucket no pueden contener '/'
+        batch = {}
+        for entry in entries:
+            bucket, key = entry.split('/', 1)
+            batch.setdefault(bucket, []).append(key)
+
+        pass_start = time.perf_counter()
+        try:
+            for bucket, keys in batch.items():
+                passes.append((bucket, *run_ingestion_pass(bucket, keys)))
+        except Exception:
+            lease_call(sink.add_pending, LEASE_KEY, entries)
+            lease_call(sink.release_lease, LEASE_KEY, owner, True)
+            raise
+        longest_pass = max(longest_pass, time.perf_counter() - pass_start)
+
+        if context is not None and context.get_remaining_time_in_millis() < 2000 * longest_pass:
+            lease_call(sink.release_lease, LEASE_KEY, owner, True)
+            print(f"Not enough time left for another pass; pending keys stay in {LEASE_KEY}")
+            break
+
+        now = time.time()
+        if not lease_call(sink.acquire_lease, LEASE_KEY, owner, now, now + COALESCE_WINDOW_SECONDS):
+            print(f"Lease {LEASE_KEY} taken over by another invocation; stopping")
+            break
+
+    return passes
+
+
+# ============================================================================
+# COMPACTACIÓN (CSV PEQUEÑOS -> UN ARCHIVO POR MES AJUSTADO)
+# ============================================================================
+
+def compacted_key(mes):
+    """Clave del archivo compactado de un mes ajustado ('YYYY-MM')."""
+    return f"{COMPACTED_PREFIX}{mes}.csv"
+
+
+def encode_compacted_month(rows):
+    """
+    CSV de un mes compactado: mismas columnas que los originales más
+    'Origen' (archivo del que viene cada fila), ordenado por fecha y origen.
+
+    Args:
+        rows: [(ordinal, origen, temp, sd)] con las temperaturas escaladas
+    """
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator='\n')
+    writer.writerow(['Fecha', 'Medias', 'Desviaciones', 'Origen'])
+
+    for ordinal, source, temp, sd in sorted(rows):
+        writer.writerow([
+            date.fromordinal(ordinal).strftime('%Y/%m/%d'),
+            format(from_scaled(temp), 'f'),
+            format(from_scaled(sd), 'f'),
+            source
+        ])
+
+    return output.getvalue().encode('utf-8')
+
+
+def run_compaction(bucket):
+    """
+    Reescribe los CSV sueltos del bucket en un archivo por mes ajustado
+    ('<COMPACTED_PREFIX>YYYY-MM.csv') y archiva los originales en
+    '<ARCHIVE_PREFIX><clave sin INPUT_PREFIX>' (ver archived_key).
+
+    Los compactados guardan todas las filas de cada mes, una por fecha y
+    archivo de origen (columna 'Origen'), no solo la que gana: al parsearlos
+    "última gana" compara los orígenes, así que un recálculo completo sobre
+    los compactados (o sobre compactados más CSV nuevos) da el mismo
+    resultado que sobre los originales. Si un CSV ya compactado se vuelve a
+    subir, sus filas compactadas se retiran y se sustituyen por las de la
+    versión nueva (como al sobrescribir el original); un mes que se queda
+    sin filas se borra. Los originales solo se archivan cuando todos los
+    meses se han escrito: si algo falla antes, conviven con los compactados
+    sin cambiar el resultado.
+
+    Si algún objeto listado (suelto o compactado) no se puede leer, no se
+    escribe ni se archiva nada: reescribir un mes sin sus filas las
+    perdería, porque los originales de un compactado ya están archivados.
+
+    Returns:
+        dict: Estadísticas de la compactación
+
+    Raises:
+        Exception: si algún objeto listado no se ha podido leer
+    """
+    metrics = get_metrics()
+    listing_stats = {}
+
+    with metrics.stage('list'):
+        objects = list(iter_csv_objects(bucket, INPUT_PREFIX, listing_stats))
+
+    raw_keys = {obj['Key'] for obj in objects if not is_compacted_key(obj['Key'])}
+    stats = {
+        "mode": "compaction",
+        "raw_objects": len(raw_keys),
+        "compacted_objects_read": 0,
+        "months_written": 0,
+        "months_deleted": 0,
+        "rows_written": 0,
+        "rows_retired": 0,
+        "objects_archived": 0,
+        "list_pages": listing_stats['list_pages'],
+        "listed_keys": listing_stats['listed_keys']
+    }
+
+    if not raw_keys:
+        return stats
+
+    series_by_origin = {}  # {origen: DailySeries} de todas las filas vigentes
+    touched_month_ids = set()
+    archivable = []
+    failed = []
+
+    with metrics.stage('fetch_parse'):
+        # Con las claves sueltas (sin el ETag del listado) el ETag es None si la lectura falla
+        fetched = fetch_csv_files(bucket, [obj['Key'] for obj in objects], by_origin=True)
+        for key, etag, parts, _ in fetched:
+            if etag is None:
+                failed.append(key)
+                continue
+
+            if is_compacted_key(key):
+                stats["compacted_objects_read"] += 1
+            else:
+                archivable.append(key)
+
+            for source, file_data in parts.items():
+                if is_compacted_key(key) and source in raw_keys:
+                    # El original se ha vuelto a subir: su versión nueva sustituye a estas filas
+                    stats["rows_retired"] += len(file_data)
+                    touched_month_ids.update(file_data.month_ids)
+                    continue
+
+                if not is_compacted_key(key):
+                    touched_month_ids.update(file_data.month_ids)
+
+                # Un mismo origen puede repartirse entre varios meses compactados
+                if source in series_by_origin:
+                    series_by_origin[source].merge(file_data)
+                else:
+                    series_by_origin[source] = file_data
+
+    if failed:
+        raise Exception(f"Could not read {len(failed)} object(s), nothing was compacted: {', '.join(failed[:10])}")
+
+    # Filas de cada mes ajustado afectado por los CSV sueltos o por las filas retiradas
+    rows_by_month = {month_id: [] for month_id in touched_month_ids}
+    merged = DailySeries()
+    for source, file_data in series_by_origin.items():
+        for position, month_id in enumerate(file_data.month_ids):
+            if month_id in rows_by_month:
+                rows_by_month[month_id].append((file_data.ordinals[position], source,
+                                                file_data.temps[position], file_data.sds[position]))
+        merge_file_data(merged, file_data)
+
+    listed_keys = {obj['Key'] for obj in objects}
+    source = get_object_source()
+
+    with metrics.stage('write'):
+        for month_id in sorted(rows_by_month):
+            rows = rows_by_month[month_id]
+            key = compacted_key(month_of_id(month_id))
+
+            if rows:
+                metrics.count('s3_put_calls')
+                with metrics.io('s3'):
+                    source.write_object(bucket, key, encode_compacted_month(rows), content_type='text/csv')
+                stats["months_written"] += 1
+                stats["rows_written"] += len(rows)
+            elif key in listed_keys:
+                with metrics.io('s3'):
+                    source.delete_object(bucket, key)
+                stats["months_deleted"] += 1
+
+    with metrics.stage('archive'):
+        for key in archivable:
+            with metrics.io('s3'):
+                source.copy_object(bucket, key, archived_key(key))
+                source.delete_object(bucket, key)
+            stats["objects_archived"] += 1
+
+    # La instantánea pasa a cubrir solo los archivos compactados
+    if SNAPSHOT_ENABLED or INGESTION_MODE == "incremental":
+        with metrics.stage('save_state'):
+            covered = {
+                obj['Key']: obj['ETag']
+                for obj in iter_csv_objects(bucket, COMPACTED_PREFIX)
+            }
+            save_snapshot(bucket, merged, covered)
+
+    return stats
+
+
+# ============================================================================
+# HANDLER PRINCIPAL
+# ============================================================================
+
+def run_compaction_event(bucket, context):
+    """
+    Ejecuta run_compaction con el lease de la ingesta (LEASE_KEY) y devuelve
+    la respuesta del handler.
+
+    La compactación lee la serie de todos los CSV y guarda la instantánea:
+    con el lease, ninguna pasada coalescida la guarda a la vez. Si otra
+    invocación tiene el lease, falla sin compactar (el reintento del evento
+    vuelve a intentarlo). Las claves que llegan mientras se compacta quedan
+    pendientes y se procesan después en esta misma invocación.
+    """
+    reset_metrics()
+
+    sink = get_control_sink()
+    owner = getattr(context, 'aws_request_id', None) or uuid.uuid4().hex
+
+    now = time.time()
+    if not lease_call(sink.acquire_lease, LEASE_KEY, owner, now, now + COALESCE_WINDOW_SECONDS):
+        raise Exception(f"Lease {LEASE_KEY} is held by another invocation; bucket {bucket} not compacted")
+
+    try:
+        stats = run_compaction(bucket)
+    except Exception as e:
+        lease_call(sink.release_lease, LEASE_KEY, owner, True)
+        import traceback
+        traceback.print_exc()
+        raise Exception(f"Error compacting bucket {bucket}: {str(e)}")
+
+    stats['ingestion_passes'] = len(drain_pending_keys(sink, owner, context))
+    stats['metrics'] = log_invocation_metrics(None, stats['mode'])
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "message": "Compaction completed successfully",
+            **stats
+        })
+    }
+
+
+def log_invocation_metrics(trigger_key, mode, records=1):
+    """Imprime las métricas de la invocación en una sola línea JSON y las devuelve."""
+    snapshot = get_metrics().snapshot()
+    print(json.dumps({
+        "event": "ingestion_metrics",
+        "trigger_file": trigger_key,
+        "mode": mode,
+        "records": records,
+        **snapshot
+    }, separators=(',', ':')))
+    return snapshot
+
+
+def iter_event_objects(event):
+    """
+    (bucket, clave, versión) de cada registro S3 del evento, en orden. La
+    versión es el sequencer de la notificación (o el ETag, o None si no
+    viene ninguno). Acepta también los registros de una cola SQS cuyo
+    cuerpo es una notificación de S3.
+    """
+    for record in event.get('Records', []):
+        if 's3' in record:
+            s3_object = record['s3']['object']
+            yield (record['s3']['bucket']['name'], urllib.parse.unquote_plus(s3_object['key']),
+                   s3_object.get('sequencer') or s3_object.get('eTag'))
+        elif 'body' in record:
+            # Las notificaciones de prueba de S3 (s3:TestEvent) no traen 'Records'
+            yield from iter_event_objects(json.loads(record['body']))
+
+
+def lambda_handler(event, context):
+
+    # Compactación bajo demanda o programada: {"action": "compact", "bucket": "..."}
+    if event.get('action') == "compact":
+        return run_compaction_event(event['bucket'], context)
+
+    # Registros del evento sin duplicados (bucket, clave, versión): dos
+    # versiones de la misma clave son registros distintos, con su marcador
+    records = []
+    candidates = []  # (registro, marcador o None)
+    seen = set()
+
+    for bucket, key, version in iter_event_objects(event):
+        record = {"bucket": bucket, "key": key}
+        records.append(record)
+
+        if (bucket, key, version) in seen:
+            record["status"] = "duplicate"
+        # Los objetos de estado, los CSV archivados o escritos por la
+        # compactación y cualquier otro archivo no CSV no se procesan
+        elif not is_csv_key(key) or is_archived_key(key) or is_compacted_key(key):
+            record["status"] = "ignored"
+        else:
+            marker = event_marker_key(bucket, key, version) if IDEMPOTENCY_ENABLED and version else None
+            candidates.append((record, marker))
+        seen.add((bucket, key, version))
+
+    trigger_key = candidates[0][0]["key"] if candidates else (records[0]["key"] if records else None)
+
+    if not candidates:
+        return {
+            "statusCode": 200,
+            "body": json.dumps({
+                "message": "Ignored non-CSV object",
+                "trigger_file": trigger_key,
+                "records": records
+            })
+        }
+
+    reset_metrics()
+
+    # Reintentos de la Lambda y notificaciones repetidas: los registros ya
+    # procesados no vuelven a disparar una pasada
+    processed_markers = find_processed_events([marker for _, marker in candidates if marker])
+    pending = {}  # {bucket: [claves]}
+    for record, marker in candidates:
+        if marker in processed_markers:
+            record["status"] = "duplicate"
+        else:
+            # Varias versiones de una clave en el evento: una sola lectura (la actual)
+            keys = pending.setdefault(record["bucket"], [])
+            if record["key"] not in keys:
+                keys.append(record["key"])
+
+    if not pending:
+        metrics = log_invocation_metrics(trigger_key, "duplicate", len(records))
+        return {
+            "statusCode": 200,
+            "body": json.dumps({
+                "message": "Duplicate event",
+                "status": "duplicate",
+                "trigger_file": trigger_key,
+                "records": records,
+                "metrics": metrics
+            })
+        }
+
+    # Una sola pasada (listado/descarga, fusión, agregación y escritura) por
+    # bucket, o las que haga el dueño del lease con la coalescencia activa.
+    # En modo incremental el lease es obligatorio: cada pasada lee y guarda
+    # la instantánea sin listar, y dos pasadas simultáneas se pisarían.
+    if COALESCE_ENABLED or INGESTION_MODE == "incremental":
+        passes = run_coalesced_ingestion(pending, context)
+    else:
+        passes = [(bucket, *run_ingestion_pass(bucket, keys)) for bucket, keys in pending.items()]
+
+    # Los registros encolados para el dueño del lease también cuentan como
+    # procesados: sus claves ya están en el conjunto pendiente
+    record_processed_events([
+        marker for record, marker in candidates
+        if marker and record.get("status") != "duplicate"
+    ])
+
+    if not passes:
+        for record in records:
+            record.setdefault("status", "queued")
+        metrics = log_invocation_metrics(trigger_key, "queued", len(records))
+        return {
+            "statusCode": 200,
+            "body": json.dumps({
+                "message": "Queued for the invocation holding the lease",
+                "trigger_file": trigger_key,
+                "records": records,
+                "metrics": metrics
+            })
+        }
+
+    # Resultado por registro: fusionado en alguna pasada o ya incluido/vacío/ilegible
+    merged_rows = {}
+    for bucket, _, files_merged in passes:
+        for key, rows in files_merged.items():
+            merged_rows[(bucket, key)] = rows
+
+    for record in records:
+        if "status" not in record:
+            rows = merged_rows.get((record["bucket"], record["key"]))
+            if rows is None:
+                record["status"] = "skipped"
+            else:
+                record["status"] = "processed"
+                record["rows"] = rows
+
+    if len(passes) > 1:
+        metrics = log_invocation_metrics(trigger_key, INGESTION_MODE, len(records))
+        body = {
+            "passes": [
+                {"bucket": bucket, **(stats if stats is not None else {"files_processed": 0})}
+                for bucket, stats, _ in passes
+            ],
+            "metrics": metrics
+        }
+    else:
+        _, stats, _ = passes[0]
+        metrics = log_invocation_metrics(trigger_key, stats['mode'] if stats else INGESTION_MODE, len(records))
+
+        if stats is None:
+            return {
+                "statusCode": 200,
+                "body": json.dumps({
+                    "message": "No CSV files found in bucket",
+                    "trigger_file": trigger_key,
+                    "records": records,
+                    "metrics": metrics
+                })
+            }
+
+        body = {**stats, "metrics": metrics}
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "message": "Processing completed successfully",
+            "trigger_file": trigger_key,
+            "records": records,
+            **body
+        })
+    }
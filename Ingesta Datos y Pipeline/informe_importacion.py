@@ -0,0 +1,113 @@
+# Informe del coste de importación de funcion_lambda.py (fase INIT del arranque
+# en frío de la Lambda). Ejecuta `python -X importtime` en un proceso limpio,
+# agrupa el tiempo propio de cada módulo por paquete de primer nivel y, opcionalmente, mide
+# también la creación de los clientes boto3 que la función crea bajo demanda.
+#
+# Uso:
+#   python informe_importacion.py [--top 15] [--repeticiones 5] [--clientes] [--json informe.json]
+
+###################
+#   LIBRERÍAS
+###################
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+#################
+# CODE
+###############
+
+MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Se ejecuta en el proceso hijo tras importar funcion_lambda
+CLIENTS_SNIPPET = '''
+import json
+import time
+import funcion_lambda
+tiempos = {}
+for servicio in ("s3", "dynamodb", "sns"):
+    inicio = time.perf_counter()
+    funcion_lambda.get_client(servicio)
+    tiempos[servicio] = (time.perf_counter() - inicio) * 1e6
+print("CLIENTES " + json.dumps(tiempos))
+'''
+
+def run_importtime(with_clients):
+    '''Lanza un intérprete limpio con -X importtime y devuelve (stderr, stdout)'''
+    code = CLIENTS_SNIPPET if with_clients else 'import funcion_lambda'
+    env = dict(os.environ)
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=MODULE_DIR, env=env, capture_output=True, text=True, check=True
+    )
+    return result.stderr, result.stdout
+
+def parse_importtime(stderr):
+    '''Devuelve [(modulo, propio_us, acumulado_us, nivel)] de la salida de -X importtime'''
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        level = (len(name) - len(name.lstrip())) // 2
+        entries.append((name.strip(), int(self_us), int(cumulative_us), level))
+    return entries
+
+def group_by_package(entries):
+    '''Suma el tiempo propio de cada módulo en su paquete de primer nivel'''
+    packages = defaultdict(int)
+    for name, self_us, _, _ in entries:
+        packages[name.split('.')[0]] += self_us
+    return packages
+
+def main():
+    parser = argparse.ArgumentParser(description='Coste de importación de funcion_lambda (arranque en frío)')
+    parser.add_argument('--top', type=int, default=15, help='Paquetes a mostrar')
+    parser.add_argument('--repeticiones', type=int, default=5, help='Procesos lanzados (se usa la mediana)')
+    parser.add_argument('--clientes', action='store_true', help='Medir también la creación de los clientes boto3')
+    parser.add_argument('--json', help='Guardar el informe en este fichero JSON')
+    args = parser.parse_args()
+
+    totals, packages, clients = [], defaultdict(list), defaultdict(list)
+    for _ in range(args.repeticiones):
+        stderr, stdout = run_importtime(args.clientes)
+        entries = parse_importtime(stderr)
+        # Tiempo acumulado del import de nivel superior de funcion_lambda
+        totals.append(next(cum for name, _, cum, level in entries if name == 'funcion_lambda' and level == 0))
+        for package, self_us in group_by_package(entries).items():
+            packages[package].append(self_us)
+        for line in stdout.splitlines():
+            if line.startswith('CLIENTES '):
+                for service, micros in json.loads(line[len('CLIENTES '):]).items():
+                    clients[service].append(micros)
+
+    report = {
+        'python': sys.version.split()[0],
+        'repeticiones': args.repeticiones,
+        'import_funcion_lambda_ms': statistics.median(totals) / 1000,
+        'paquetes_ms': {
+            package: statistics.median(values) / 1000
+            for package, values in sorted(packages.items(), key=lambda kv: -statistics.median(kv[1]))
+        },
+    }
+    if clients:
+        report['clientes_ms'] = {service: statistics.median(values) / 1000 for service, values in clients.items()}
+
+    print(f"Importar funcion_lambda: {report['import_funcion_lambda_ms']:.1f} ms (mediana de {args.repeticiones})")
+    print("Paquetes con más coste propio:")
+    for package, millis in list(report['paquetes_ms'].items())[:args.top]:
+        print(f"  {package:<28} {millis:8.2f} ms")
+    for service, millis in report.get('clientes_ms', {}).items():
+        print(f"  cliente {service:<20} {millis:8.2f} ms")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as output:
+            json.dump(report, output, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+# Comprueba que la compactación no cambia el resultado de la ingesta: sobre un
+# bucket en memoria se encadenan al azar subidas de CSV nuevos, subidas de
+# nuevo de CSV ya subidos (también de los ya compactados) con solo parte de
+# sus filas y compactaciones, y después de cada paso se compara la tabla de
+# agregados con la de un recálculo completo desde cero sobre la última versión
+# de cada CSV original. Tras cada compactación se compara también el
+# recálculo sobre lo que queda en el bucket (compactados y CSV sueltos).
+# Termina con código 1 si algún paso no coincide.
+#
+# Uso:
+#   python verificar_compactacion.py [--datos ../Data] [--modo full|incremental] [--pruebas 10] [--pasos 12]
+#                                    [--prefijo datos/] [--semilla 0]
+
+###################
+#   LIBRERÍAS
+###################
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+
+#################
+# CODE
+###############
+
+def read_csv_files(data_dir):
+    '''{nombre: (cabecera, [líneas])} de los CSV del directorio de datos'''
+    files = {}
+    for name in sorted(os.listdir(data_dir)):
+        if name.lower().endswith('.csv'):
+            with open(os.path.join(data_dir, name), 'rb') as f:
+                lines = f.read().decode('utf-8').splitlines()
+            files[name] = (lines[0], lines[1:])
+    return files
+
+def encode_csv(header, lines):
+    return ('\n'.join([header] + lines) + '\n').encode('utf-8')
+
+def table_items(sink):
+    '''Items de agregados de la tabla, sin los campos que dependen de la ejecución'''
+    return {
+        key: {name: str(value) for name, value in item.items() if name not in ('last_updated', 'content_hash')}
+        for key, item in sorted(sink.items.items())
+        if not key.startswith('_')
+    }
+
+def invoke(funcion_lambda, event):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return funcion_lambda.lambda_handler(event, None)
+
+def upload_event(key):
+    return {'Records': [{'s3': {'bucket': {'name': 'b'}, 'object': {'key': key}}}]}
+
+def recompute(funcion_lambda, objects, prefix):
+    '''Tabla de una ingesta desde cero (sin estado ni agregados previos) sobre 'objects' '''
+    sink = funcion_lambda.MemorySink()
+    funcion_lambda.configure_backends(source=funcion_lambda.MemoryObjectSource({'b': dict(objects)}),
+                                      sink=sink, notifier=funcion_lambda.MemoryNotifier())
+    invoke(funcion_lambda, upload_event(f"{prefix}recalculo.csv"))
+    return table_items(sink)
+
+def run_trial(funcion_lambda, files, steps, prefix, rng):
+    '''Devuelve la lista de pasos cuyo resultado no coincide con el recálculo'''
+    source = funcion_lambda.MemoryObjectSource()
+    sink = funcion_lambda.MemorySink()
+    notifier = funcion_lambda.MemoryNotifier()
+
+    names = list(files)
+    rng.shuffle(names)
+    originals = {}  # {clave: última versión subida}
+    mismatches = []
+
+    for step in range(steps):
+        funcion_lambda.configure_backends(source=source, sink=sink, notifier=notifier)
+        uploaded = sorted(originals)
+        action = rng.random()
+
+        if action < 0.25 and uploaded:
+            invoke(funcion_lambda, {'action': 'compact', 'bucket': 'b'})
+            description = "compactar"
+        else:
+            if action < 0.55 and uploaded:
+                # Otra versión de un CSV ya subido (puede estar compactado) con menos fechas
+                key = rng.choice(uploaded)
+                header, lines = files[key[len(prefix):]]
+                kept = sorted(rng.sample(range(len(lines)), rng.randint(0, len(lines) - 1)))
+                body = encode_csv(header, [lines[i] for i in kept])
+                description = f"subir de nuevo {key} ({len(kept)} filas)"
+            elif names:
+                key = f"{prefix}{names.pop()}"
+                body = encode_csv(*files[key[len(prefix):]])
+                description = f"subir {key}"
+            else:
+                continue
+
+            originals[key] = body
+            source.write_object('b', key, body)
+            invoke(funcion_lambda, upload_event(key))
+
+        result = table_items(sink)
+        live = {
+            key: body for key, (body, _) in source.buckets['b'].items()
+            if funcion_lambda.is_csv_key(key) and not funcion_lambda.is_archived_key(key)
+        }
+
+        expected = recompute(funcion_lambda, originals, prefix)
+        if result != expected:
+            mismatches.append(f"paso {step} ({description}): la tabla no coincide con el recálculo")
+        elif description == "compactar" and recompute(funcion_lambda, live, prefix) != expected:
+            mismatches.append(f"paso {step} ({description}): el bucket compactado no equivale a los originales")
+
+    return mismatches
+
+def main():
+    parser = argparse.ArgumentParser(description='Equivalencia de la compactación con el recálculo completo')
+    parser.add_argument('--datos', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Data'))
+    parser.add_argument('--modo', choices=['full', 'incremental'], default='full')
+    parser.add_argument('--pruebas', type=int, default=10, help='Secuencias aleatorias independientes')
+    parser.add_argument('--pasos', type=int, default=12, help='Subidas y compactaciones por secuencia')
+    parser.add_argument('--prefijo', default='', help='INPUT_PREFIX de los CSV')
+    parser.add_argument('--semilla', type=int, default=0)
+    args = parser.parse_args()
+
+    # La configuración de funcion_lambda se lee al importarla
+    os.environ['INGESTION_MODE'] = args.modo
+    os.environ['INPUT_PREFIX'] = args.prefijo
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import funcion_lambda
+
+    files = read_csv_files(args.datos)
+    if not files:
+        sys.exit(f"No hay CSV en {args.datos}")
+
+    failures = 0
+    for trial in range(args.pruebas):
+        mismatches = run_trial(funcion_lambda, files, args.pasos, args.prefijo, random.Random(args.semilla + trial))
+        for mismatch in mismatches:
+            print(f"prueba {trial}, {mismatch}")
+        failures += bool(mismatches)
+
+    print(f"{args.pruebas - failures} de {args.pruebas} secuencias equivalentes al recálculo completo")
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -28,6 +28,8 @@ Estructura de Tabla DynamoDB (Flat Table):
         - max_diff_temp: Diferencia con temperatura máxima mes anterior (Decimal)
         - mean_temp_count: Número de registros procesados (Number)
         - last_updated: Timestamp de última actualización (String ISO)
+        - content_hash: Hash de las métricas, usado por la Lambda para no
+          reescribir meses sin cambios (String)
 
 Requisitos:
     - Flask 3.0.0
@@ -539,13 +541,23 @@ def get_available_months():
     try:
         logger.info("Listando meses disponibles")
         
-        # Escanear tabla completa (solo proyectando monthYear para eficiencia)
-        response = table.scan(ProjectionExpression="monthYear")
-        items = response.get("Items", [])
+        # Escanear tabla completa (solo proyectando monthYear para eficiencia).
+        # Cada página del scan se corta a 1 MB contando el item completo (no
+        # solo lo proyectado): se siguen las páginas con LastEvaluatedKey
+        items = []
+        scan_kwargs = {"ProjectionExpression": "monthYear"}
+        while True:
+            response = table.scan(**scan_kwargs)
+            items.extend(response.get("Items", []))
+            if "LastEvaluatedKey" not in response:
+                break
+            scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
 
         # Extraer lista de meses únicos y ordenar
-        # Como monthYear es la Partition Key, cada valor es único automáticamente
-        months_list = sorted([item["monthYear"] for item in items])
+        # Como monthYear es la Partition Key, cada valor es único automáticamente.
+        # Los items de control de la ingesta viven en su propia tabla; se
+        # descartan por si quedan en esta los de versiones anteriores ("_lease")
+        months_list = sorted([item["monthYear"] for item in items if not item["monthYear"].startswith("_")])
 
         logger.info(f"Total meses disponibles: {len(months_list)}")
         